@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 
-import socket
-from struct import pack,unpack
-from time import sleep,monotonic
-from sys import argv,exit,stdin,stderr
+from time import sleep,monotonic,process_time
+loadstart=monotonic();loadcpu=process_time() # for TIMING
+from struct import pack,unpack,Struct
+from sys import argv,exit,stdin,stderr,byteorder
+from array import array
 
 # other imports are placed where they are needed, to avoid crashing whole software instead of a single function on a missing dependency
 
@@ -16,6 +17,49 @@ DEFAULT_MODBUS_ADDR=1
 
 stdlog=stderr
 
+# startup phases for TIMING: phase name -> monotonic time of its end, first occurrence only; None when not enabled
+timing=None
+
+def timemark(name):
+  if timing!=None and name not in timing: timing[name]=monotonic()
+
+
+####################
+##
+##  ERRORS
+##
+####################
+
+# failures of the device layers are raised as these; the command line maps them to its exit codes
+class RDError(Exception):
+  exitcode=1
+
+  def __init__(self,msg,exitcode=None):
+    super().__init__(msg)
+    if exitcode!=None: self.exitcode=exitcode
+
+# port cannot be opened, or link lost with reconnect disabled
+class RDConnectError(RDError,ConnectionError):
+  exitcode=12
+
+# no valid response after all retries; subclasses by the last failure
+class RDTransactionError(RDError):
+  exitcode=10
+
+class RDTimeoutError(RDTransactionError,TimeoutError): pass
+
+class RDCRCError(RDTransactionError): pass
+
+# device answered with MODBUS exception code
+class RDModbusError(RDTransactionError):
+  def __init__(self,code,msg):
+    super().__init__(msg)
+    self.code=code
+
+# device type not supported
+class RDUnknownDeviceError(RDError):
+  exitcode=50
+
 
 ####################
 ##
@@ -25,7 +69,7 @@ stdlog=stderr
 
 
 class LowLevelSerPort:
-  import serial
+  serial=None                       # pyserial module, imported on connect; TCP-only use does not need it
   serport='/dev/ttyUSB0'            # target serial port
   baudrate=0
   port=None                         # physical port instance
@@ -35,6 +79,8 @@ class LowLevelSerPort:
   timeout=3
   connretries=5
   connected=False
+  lowlatency=False # no effect here, input buffer reset never blocks
+  flushedbytes=0   # stale bytes discarded by recvflush
 
   def __init__(self,portname='/dev/ttyUSB0',baudrate=DEFAULT_BAUDRATE):
     self.serport=portname
@@ -42,20 +88,23 @@ class LowLevelSerPort:
     pass
 
   def connect(self):
+    if self.serial==None:
+      try: import serial
+      except ImportError: raise RDConnectError('ERRPORTCONN: serial port needs pyserial, not installed')
+      LowLevelSerPort.serial=serial
     if self.verbconn: print('SERPORT:connecting to',self.serport,'@',self.baudrate,file=stdlog)
     for t in range(0,self.connretries):
       try:
-        if t>0: print('retrying...',t)
+        if t>0: print('retrying...',t,file=stdlog)
         #self.port=self.serial.Serial(self.serport,self.baudrate, timeout=self.timeout)
         self.port=self.serial.serial_for_url(self.serport,self.baudrate, timeout=self.timeout)
         self.connected=True
         break
       except Exception as e:
-        print('PORTCONNERR:',e)
+        print('PORTCONNERR:',e,file=stdlog)
         sleep(1)
     if not self.connected:
-      print('ERRPORTCONN: cannot connect to',self.serport,'- too many retries. Aborting.',file=stdlog)
-      exit(12)
+      raise RDConnectError(f'ERRPORTCONN: cannot connect to {self.serport} - too many retries. Aborting.')
     if self.verbconn: print('SERPORT:connected',file=stdlog)
     return None
 
@@ -74,10 +123,21 @@ class LowLevelSerPort:
     if showpacket!=None and self.verbconn: showpacket(res,name='SERPORT:RECV',check=False)
     return res
 
+  # receive into buffer whatever is waiting, or wait for at least one byte; returns count, 0 on timeout
+  def recvinto(self,view,showpacket=None):
+    n=self.port.readinto(view[:max(1,min(len(view),self.port.in_waiting))])
+    if showpacket!=None and self.verbconn: showpacket(bytes(view[:n]),name='SERPORT:RECV',check=False)
+    return n
+
   def recvflush(self):
-    #n=self.port.in_waiting
+    n=self.port.in_waiting
     self.port.reset_input_buffer()
-    return 0
+    self.flushedbytes+=n
+    return n
+
+  def settimeout(self,timeout):
+    self.timeout=timeout
+    if self.port!=None: self.port.timeout=timeout
 
 
 
@@ -97,6 +157,10 @@ class LowLevelTcpPort:
   flushtimeout=0.02
   connretries=5
   connected=False
+  lowlatency=False # TCP_NODELAY, flush only what is already received instead of waiting flushtimeout
+  flushedbytes=0   # stale bytes discarded by recvflush
+  timeouts=0       # receive timeouts in a row; short adaptive timeouts reconnect only after several
+  reconnecttimeouts=3
 
   reconnect=True
 
@@ -105,9 +169,11 @@ class LowLevelTcpPort:
     self.ipport=port
 
   def connect(self):
+    import socket
     if self.verbconn: print('SOCK:connecting to',self.ipaddr,':',self.ipport,file=stdlog)
     self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     self.sock.settimeout(self.timeout)
+    if self.lowlatency: self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
     for t in range(0,self.connretries):
       try:
         if t>0: print('SOCK:connection retrying...',t,file=stdlog)
@@ -115,47 +181,80 @@ class LowLevelTcpPort:
         self.connected=True
         break
       except Exception as e:
-        print('SOCKCONNERR:',e)
+        print('SOCKCONNERR:',e,file=stdlog)
         sleep(min(0.5+t,5)) # increase retries delay, max. 5s
     if not self.connected:
-      print('ERRSOCKCONN: cannot connect to',self.ipaddr,':',self.ipport,'- too many retries. Aborting.',file=stdlog)
-      exit(12)
-    #raise(BaseException('MODBUS failure: too many retries!')) # TODO: cleaner fail
+      raise RDConnectError(f'ERRSOCKCONN: cannot connect to {self.ipaddr}:{self.ipport} - too many retries. Aborting.')
     if self.verbconn: print('SOCK:connected',file=stdlog)
     return self.sock
 
   def close(self):
     if self.verbconn: print('SOCK:closed',file=stdlog)
+    if self.verbconn and self.flushedbytes>0: print('SOCK:stale bytes flushed:',self.flushedbytes,file=stdlog)
     self.sock.close()
 
   def send(self,raw,showpacket=None):
     if showpacket!=None and self.verbport: showpacket(raw,name='SOCK:SEND',check=False,file=stdlog)
     try:  return self.sock.sendall(raw)
-    except socket.error as e:
+    except OSError as e:
       print('SOCK:SEND:ERR:',e,file=stderr)
       if self.reconnect: self.connect()
 
   def recv(self,l,showpacket=None):
     try: res=self.sock.recv(l)
-    except socket.error as e:
+    except OSError as e:
       print('SOCK:RECV:ERR:',e,file=stderr)
       if self.reconnect:
         try: self.close()
         except Exception as e: print('SOCK:CLOSE:ERR:',e,file=stderr)
         self.connect()
         return b''
-      else:
-        print('SOCK:RECV:aborting',file=stderr)
-        exit(15)
+      else: raise RDConnectError('SOCK:RECV:aborting',exitcode=15)
     if showpacket!=None and self.verbport: showpacket(res,name='SOCK:RECV',check=False,file=stdlog)
     return res
 
+  # receive into buffer whatever the socket gives; returns count, 0 on timeout or error (after reconnect)
+  def recvinto(self,view,showpacket=None):
+    try: n=self.sock.recv_into(view);self.timeouts=0
+    except OSError as e:
+      if isinstance(e,TimeoutError):
+        self.timeouts+=1
+        if self.timeouts<self.reconnecttimeouts: return 0
+        self.timeouts=0
+      print('SOCK:RECV:ERR:',e,file=stderr)
+      if self.reconnect:
+        try: self.close()
+        except Exception as e: print('SOCK:CLOSE:ERR:',e,file=stderr)
+        self.connect()
+        return 0
+      else: raise RDConnectError('SOCK:RECV:aborting',exitcode=15)
+    if showpacket!=None and self.verbport: showpacket(bytes(view[:n]),name='SOCK:RECV',check=False)
+    return n
+
   def recvflush(self):
     #print('flush')
+    if self.lowlatency: return self.recvflushnow()
     self.sock.settimeout(self.flushtimeout)
     try: n=len(self.sock.recv(1024))
-    except socket.timeout: n=0
+    except OSError: n=0 # timeout, nothing stale; errors are left for the following recv
     self.sock.settimeout(self.timeout)
+    self.flushedbytes+=n
+    return n
+
+  def settimeout(self,timeout):
+    self.timeout=timeout
+    if self.sock!=None: self.sock.settimeout(timeout)
+
+  # discard only data already waiting in the socket, do not block
+  def recvflushnow(self):
+    from select import select
+    n=0
+    while select([self.sock],[],[],0)[0]:
+      try: r=self.sock.recv(1024)
+      except OSError: break # left for the following recv to handle
+      if r==b'': break # peer closed; following recv reconnects
+      n+=len(r)
+    self.flushedbytes+=n
     return n
 
 
@@ -166,6 +265,76 @@ class LowLevelTcpPort:
 ############################
 
 
+# transaction counters of a MODBUS link, per function code and register range
+class RDModbusStats:
+  RTT_EDGES=[0.5,1,2,5,10,20,50,100,200,500,1000,2000] # round-trip histogram bucket upper edges, ms; one more bucket above
+  COUNTERS=['req','ok','fail','retry','timeout','crc','badaddr','badfunc','badlen','exc','error','txbytes','rxbytes']
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.ranges={}
+    self.started=monotonic()
+
+  # counters for request data (after address and function byte), created on first use
+  def entry(self,func,data):
+    start,num=unpack('>HH',data[0:4])
+    if func==0x06: num=1 # single write, second word is the value
+    e=self.ranges.get((func,start,num))
+    if e==None:
+      e=dict.fromkeys(self.COUNTERS,0)
+      e.update(func=func,start=start,num=num,excodes={},rttsum=0.0,rttmin=0.0,rttmax=0.0,hist=[0]*(len(self.RTT_EDGES)+1))
+      self.ranges[(func,start,num)]=e
+    return e
+
+  def addrtt(self,e,ms):
+    from bisect import bisect_left
+    if e['ok']==0 or ms<e['rttmin']: e['rttmin']=ms
+    if ms>e['rttmax']: e['rttmax']=ms
+    e['rttsum']+=ms
+    e['hist'][bisect_left(self.RTT_EDGES,ms)]+=1
+
+  # round-trip percentile estimated from histogram, as bucket upper edge
+  def rttpct(self,e,pct):
+    n=0
+    for t in range(0,len(e['hist'])):
+      n+=e['hist'][t]
+      if n>0 and n>=pct*e['ok']: return min(e['rttmax'],self.RTT_EDGES[t]) if t<len(self.RTT_EDGES) else e['rttmax']
+    return 0.0
+
+  # all counters as dict, ranges sorted by function and start; link=extra link-wide counters
+  def getstats(self,link={}):
+    a={'secs':round(monotonic()-self.started,3)}
+    a.update(link)
+    a['ranges']=[]
+    for k in sorted(self.ranges):
+      e=self.ranges[k]
+      r={x:e[x] for x in ['func','start','num']+self.COUNTERS}
+      r['excodes']={f'{x:02x}':e['excodes'][x] for x in sorted(e['excodes'])}
+      if e['ok']>0:
+        r.update({x:round(y,3) for x,y in [('rttmin',e['rttmin']),('rttavg',e['rttsum']/e['ok']),('rttmax',e['rttmax']),
+                 ('rttp50',self.rttpct(e,0.5)),('rttp95',self.rttpct(e,0.95)),('rttp99',self.rttpct(e,0.99))]})
+      r['hist']={(f'<={x:g}' if t<len(self.RTT_EDGES) else f'>{self.RTT_EDGES[-1]:g}'):e['hist'][t] for t,x in enumerate(self.RTT_EDGES+[0]) if e['hist'][t]>0}
+      a['ranges'].append(r)
+    return a
+
+  # print counters as table, or as one JSON line
+  def printstats(self,json=False,link={},file=None):
+    a=self.getstats(link)
+    if json:
+      from json import dumps
+      print(dumps(a),file=file);return
+    print(f'MODBUS statistics, {a["secs"]:.1f} s,',' '.join(f'{x}={y}' for x,y in link.items()),file=file)
+    print('func regs     '+''.join(f'{x:>8}' for x in self.COUNTERS[:11])+'  txbytes  rxbytes   min/avg/p95/max ms',file=file)
+    for r in a['ranges']:
+      regs=f'{r["start"]}+{r["num"]}'
+      rtt=f'{r["rttmin"]}/{r["rttavg"]}/{r["rttp95"]}/{r["rttmax"]}' if r['ok']>0 else '-'
+      print(f'{r["func"]:02x}   {regs:<9}'+''.join(f'{r[x]:>8}' for x in self.COUNTERS[:11])+f' {r["txbytes"]:>8} {r["rxbytes"]:>8}   {rtt}',file=file)
+      if r['excodes']!={}: print('       exception codes:',' '.join(f'{x}:{y}' for x,y in r['excodes'].items()),file=file)
+      if r['hist']!={}: print('       rtt ms:',' '.join(f'{x}:{y}' for x,y in r['hist'].items()),file=file)
+
+
 class RDModbus:
   # dummy init
 
@@ -185,8 +354,36 @@ class RDModbus:
   MODBUS_FUNC_WRITESINGLE16=0x06
 
 
+  rxbuf=None      # persistent receive buffer, frames are reassembled here
+  rxlen=0         # valid bytes in rxbuf
+  droppedbytes=0  # garbage bytes skipped when resynchronizing on a frame start
+  lastexcode=0    # last exception code answered by the device
+  failkind='timeout' # counter name of the last failed attempt
+
+  stats=None      # RDModbusStats of this link
+  curstat=None    # counters of the running transaction
+  rxattempt=0     # bytes received in the running attempt
+  txattempt=0     # bytes sent in the running attempt
+
+  turnaround=0.01 # device response delay in s, smoothed round trips minus wire time (SRTT)
+  rttvar=0        # mean deviation of turnaround (RTTVAR)
+  rttsamples=0    # turnaround samples, first attempts only
+  rtomin=0.1      # adaptive receive timeout bounds are rtomin..timeout
+  attempt=0       # retry number of the running transaction
+  attempttimeout=3 # receive timeout of the running attempt
+  losses=0        # consecutive lost attempts
+  breaklosses=6   # consecutive losses opening the circuit breaker, 0=never
+  backoffbase=0.02 # bound of random delay before first retry, doubled per retry
+  backoffmax=1    # cap of retry delay bound
+  lastrxtime=0    # end of the last transaction, start of the inter-frame gap
+  MAXFRAMES=32    # request frames memoized
+
   def __init__(self,addr=DEFAULT_MODBUS_ADDR):
     self.addr=addr
+    self.rxbuf=bytearray(512) # max. response is 5+2*125 bytes, rest for leading garbage
+    self.rxview=memoryview(self.rxbuf)
+    self.stats=RDModbusStats()
+    self.frames={}
 
   def initport(self,comm):
     self.comm=comm
@@ -235,45 +432,246 @@ class RDModbus:
       for byte in data:
           index = crc_high ^ int(byte);crc_high = crc_low ^ self.MODBUSCRC_HIGH_BYTES[index];crc_low = self.MODBUSCRC_LOW_BYTES[index]
       return bytes([crc_high, crc_low])
-  def modbus_add_crc(self,packet: bytes) -> bytes: #Add CRC-16 to bytes packet
-      return packet + self.modbus_crc16(packet)
-  def modbus_check_crc(self,packet: bytes) -> bool: #Validate signed bytes packet
-      return self.modbus_crc16(packet) == b'\x00\x00'
 #### INCLUDE END
 
-
-  # add crc to packet, send
+  # CRC-16 tables, reflected, CRC low byte first: byte-indexed, and indexed by CRC xor little-endian word from memoryview;
+  # the word table costs 65536 steps to build, so it is made only after enough data went through (polling, not one command),
+  # and only on little-endian hosts, big-endian ones stay on the byte table
+  CRC8TABLE=None
+  CRC16TABLE=None
+  CRC16AFTER=1<<17 # bytes
+  crcbytes=0
+
+  @classmethod
+  def crctable8(cls):
+    cls.CRC8TABLE=[(cls.MODBUSCRC_LOW_BYTES[x]<<8)|cls.MODBUSCRC_HIGH_BYTES[x] for x in range(0,256)]
+    return cls.CRC8TABLE
+
+  @classmethod
+  def crctable16(cls):
+    t8=cls.CRC8TABLE or cls.crctable8()
+    t16=[0]*65536
+    for x in range(0,65536):
+      c=(x>>8)^t8[x&0xff]
+      c=(c>>8)^t8[c&0xff]
+      t16[x]=c
+    cls.CRC16TABLE=t16
+    return t16
+
+  # CRC-16 of data as integer, low byte goes first on the wire; 0 over a frame with its CRC
+  def crc16(self,data):
+    t=RDModbus.CRC16TABLE
+    crc=0xffff
+    if t==None:
+      RDModbus.crcbytes+=len(data)
+      if RDModbus.crcbytes>self.CRC16AFTER and byteorder=='little': t=self.crctable16()
+      else:
+        t8=self.CRC8TABLE or self.crctable8()
+        for x in data: crc=(crc>>8)^t8[(crc^x)&0xff]
+        return crc
+    n=len(data)&~1
+    for w in memoryview(data)[:n].cast('H'): crc=t[crc^w]
+    if n<len(data): crc=(crc>>8)^self.CRC8TABLE[(crc^data[n])&0xff]
+    return crc
+
+  def modbus_add_crc(self,packet):
+    return packet+pack('<H',self.crc16(packet))
+
+  def modbus_check_crc(self,packet):
+    return self.crc16(packet)==0
+
+  # complete request frame with CRC; repeated ones, like the polling reads, from the memo
+  def mframe(self,func,packet):
+    key=(self.addr,func,packet)
+    frame=self.frames.get(key)
+    if frame==None:
+      frame=self.modbus_add_crc(pack('>BB',self.addr,func)+packet)
+      if len(self.frames)>=self.MAXFRAMES: del self.frames[next(iter(self.frames))] # oldest out
+      self.frames[key]=frame
+    return frame
+
+
+  # send frame; returns the time it went out, after the wait of the flush, for the turnaround time
   def msend(self,packet):
     if self.comm.recvflush()>0: self.mprinterr('nonzero recv flush')
-    packet=self.modbus_add_crc(packet)
-    if self.verbm: self.showpacket(packet,name='MODBUS:SEND',check=True)
+    packet=self.mprepare(packet)
+    t0=monotonic()
     self.comm.send(packet,self.showpacket)
+    return t0
 
-  # receive packet of known length
-  def mrecvlen(self,l):
-    packet=self.comm.recv(l,self.showpacket)
+  # drop stale received data; packet is a complete frame with crc
+  def mprepare(self,packet):
+    if self.rxlen>0: self.mdrop(self.rxlen) # leftovers after the previous frame are stale now
+    if self.verbm: self.showpacket(packet,name='MODBUS:SEND',check=True)
+    self.rxattempt=0
+    self.txattempt=len(packet)
+    self.mcount('txbytes',len(packet))
     return packet
 
-  def mrecvvar(self):
-    packet=self.comm.recv(3,self.showpacket)
-    if len(packet)<3: return packet
-    num=packet[2]+2 # length in byte3, plus 2 bytes for CRC
-    packet+=self.comm.recv(num,self.showpacket)
-    return packet
+  # add to counter of running transaction
+  def mcount(self,name,n=1):
+    if self.curstat!=None: self.curstat[name]+=n
+
+  # start counting transaction of func with request data
+  def mstatbegin(self,func,packet):
+    self.curstat=self.stats.entry(func,packet)
+    self.curstat['req']+=1
+
+  # account round trip of finished attempt sent at t0, update turnaround estimate, pass response through
+  # the flush before the send is not part of it: the turnaround is the device and link delay only
+  def mstatrtt(self,res,t0):
+    self.lastrxtime=monotonic()
+    if res==False: return res
+    rtt=self.lastrxtime-t0
+    if self.curstat!=None: self.stats.addrtt(self.curstat,1000*rtt)
+    if self.attempt==0: self.rttsample(max(0,rtt-(self.txattempt+self.rxattempt)*self.bytetime())) # retried answers may be late ones
+    return res
+
+  # Jacobson/Karels estimator of turnaround and its deviation
+  def rttsample(self,ta):
+    if self.rttsamples==0: self.turnaround=ta;self.rttvar=ta/2
+    else:
+      self.rttvar+=(abs(self.turnaround-ta)-self.rttvar)/4
+      self.turnaround+=(ta-self.turnaround)/8
+    self.rttsamples+=1
+
+  # receive timeout for retry t of request/response of txlen/rxlen bytes: turnaround plus 4 deviations plus wire time,
+  # doubled per retry; fixed timeout until measured, and for circuit breaker probes
+  def rto(self,txlen,rxlen,t=0):
+    if self.rttsamples==0 or self.breakeropen(): return self.timeout
+    rto=(self.turnaround+4*self.rttvar+(txlen+rxlen)*self.bytetime())*(1<<min(t,16))
+    return min(self.timeout,max(self.rtomin,rto))
+
+  # circuit breaker: after breaklosses lost attempts in a row, transactions fail after a single probe
+  def breakeropen(self):
+    return self.breaklosses>0 and self.losses>=self.breaklosses
+
+  # random delay before retry t, exponential bound
+  def backoff(self,t):
+    from random import uniform
+    return uniform(0,min(self.backoffmax,self.backoffbase*(1<<min(t-1,16))))
+
+  # set up attempt t of transaction, port timeout changed only when notably different
+  def mattempt(self,t,txlen,rxlen):
+    self.attempt=t
+    self.attempttimeout=tmo=self.rto(txlen,rxlen,t)
+    if abs(tmo-self.comm.timeout)>0.25*tmo: self.comm.settimeout(tmo)
+
+  # account result of attempt; returns True on success
+  # exception answer shows the link working, it is not a loss
+  def mresult(self,resp):
+    if resp!=False or self.failkind=='exc':
+      if self.breakeropen(): print('MODBUS: link back, circuit breaker closed',file=stdlog)
+      self.losses=0
+      return resp!=False
+    self.losses+=1
+    if self.losses==self.breaklosses: print(f'MODBUS: {self.losses} attempts lost, circuit breaker open',file=stdlog)
+    return False
+
+  # last attempt failed in a way retries cannot fix: illegal function, address, value
+  def mfinal(self):
+    return self.failkind=='exc' and self.lastexcode in [1,2,3]
+
+  # response bytes expected for request
+  def mresplen(self,func,expectlen):
+    return 5+expectlen if func==self.MODBUS_FUNC_READMULTI16 else 8
+
+  # estimator and breaker state
+  def getrtt(self):
+    return {'srttms':round(1000*self.turnaround,3),'rttvarms':round(1000*self.rttvar,3),'samples':self.rttsamples,
+            'rtoms':round(1000*self.rto(8,5+2),1),'rto42ms':round(1000*self.rto(8,5+2*42),1),
+            'losses':self.losses,'breaker':'open' if self.breakeropen() else 'closed'}
 
-  # receive packet of variable length specified in 3rd byte
-  def mrecv(self,l=0):
-    if l==0: packet=self.mrecvvar()
-    else:    packet=self.mrecvlen(l)
+  def printrtt(self,json=False,file=None):
+    a=self.getrtt()
+    if json:
+      from json import dumps
+      print(dumps(a),file=file);return
+    print('RTT:',' '.join(f'{x}={y}' for x,y in a.items()),file=file)
+
+  # wire time of one RTU character (11 bits); TCP bridges are assumed to run the default baudrate
+  def bytetime(self):
+    return 11/(getattr(self.comm,'baudrate',0) or DEFAULT_BAUDRATE)
+
+  # silent interval between frames: 3.5 characters, fixed 1.75 ms above 19200 baud
+  def framegap(self):
+    return 0.00175 if self.bytetime()<11/19200 else 3.5*self.bytetime()
+
+  # remaining time of inter-frame gap after the last transaction
+  def gapwait(self):
+    return self.lastrxtime+self.framegap()-monotonic()
+
+  # link cost model for read and write planning: seconds per frame (turnaround, gap), seconds per byte; wire time only
+  def costmodel(self):
+    return self.turnaround+self.framegap(),self.bytetime()
+
+  # link-wide counters not tied to a transaction
+  def getlinkstats(self):
+    return {'droppedbytes':self.droppedbytes,'flushedbytes':getattr(self.comm,'flushedbytes',0),
+            'srttms':round(1000*self.turnaround,3),'breaker':'open' if self.breakeropen() else 'closed'}
+
+  def printstats(self,json=False,file=None):
+    self.stats.printstats(json=json,link=self.getlinkstats(),file=file)
+
+  # discard n bytes from start of receive buffer
+  def mdrop(self,n,count=True):
+    if n<=0: return
+    if count:
+      self.droppedbytes+=n
+      if self.verbm: print('MODBUS:RESYNC: dropped',n,'bytes',file=stdlog)
+    self.rxbuf[0:self.rxlen-n]=self.rxbuf[n:self.rxlen]
+    self.rxlen-=n
+
+  # find frame answering to func (or its exception) in receive buffer, skip garbage before it
+  # returns the frame and removes it from buffer, or None if more data is needed
+  def mscanframe(self,func,expectlen=-1):
+    buf=self.rxbuf
+    i=0
+    while i+1<self.rxlen:
+      if buf[i]!=self.addr or buf[i+1]&0x7f!=func: i+=1;continue
+      if buf[i+1]&0x80: l=5 # exception response
+      elif func==self.MODBUS_FUNC_READMULTI16:
+        if i+2>=self.rxlen: break # length byte not here yet
+        if expectlen>=0 and buf[i+2]!=expectlen: i+=1;continue
+        l=5+buf[i+2]
+      else: l=8
+      if i+l>self.rxlen: break # incomplete, wait for rest
+      if self.modbus_check_crc(self.rxview[i:i+l]):
+        self.mdrop(i)
+        packet=bytes(buf[:l])
+        self.mdrop(l,count=False)
+        return packet
+      i+=1 # checksum failed, not a frame start
+    self.mdrop(i) # nothing before i can start a frame
+    if self.rxlen==len(buf): self.mdrop(1)
+    return None
+
+  # receive frame, reassembling from partial reads
+  # returns the frame, or b'' if no valid frame came before timeout
+  def mrecvframe(self,func,expectlen=-1):
+    deadline=monotonic()+self.attempttimeout
+    while True:
+      packet=self.mscanframe(func,expectlen)
+      if packet!=None: return packet
+      if monotonic()>deadline: return b''
+      n=self.comm.recvinto(self.rxview[self.rxlen:],self.showpacket)
+      if n==0: return b''
+      self.rxlen+=n
+      self.rxattempt+=n
+      self.mcount('rxbytes',n)
+
+  # receive response to func; CRC is verified by the frame reader
+  def mrecv(self,func,expectlen=-1):
+    packet=self.mrecvframe(func,expectlen)
     if self.verbm: self.showpacket(packet,name='MODBUS:RECV',check=True)
-    return packet,self.modbus_check_crc(packet)
+    return packet,packet!=b''
 
   # print error; todo, stderr here
   def mprinterr(self,*s):
     print('ERRMODBUS:',*s,file=stdlog)
 
   def getmodbuserrstr(self,func, packet,errno):
-    packetstr=self.strpacket(packet)+':xx:xx' # CRC is added later
+    packetstr=self.strpacket(packet)
     s=' packet='+packetstr
     s2=f' func={func} addr={packet[2]:02x}{packet[3]:02x} len={packet[4]:02x}{packet[5]:02x}'+s
     if errno==1:  return 'Illegal function:'+s2
@@ -291,46 +689,76 @@ class RDModbus:
 
   # send-receive pair, with timeout
   def msendrecv_attempt(self,func,packet,resplen=0,expectlen=-1):
-    packet=pack('>BB',self.addr,func)+packet
+    packet=self.mframe(func,packet)
     if self.dodelay: self.dodelay=True;sleep(0.005)
-    self.msend(packet)
+    wait=self.gapwait()
+    if wait>0: sleep(wait)
+    t0=self.msend(packet)
     try:
-      res,state=self.mrecv(resplen)
-    except socket.timeout: self.mprinterr('timeout');return False
-    except Exception as e: self.mprinterr('exception:',e);return False
+      res,state=self.mrecv(func,expectlen)
+    except TimeoutError: return self.mfail('timeout','timeout')
+    except Exception as e: return self.mfail('error','exception:',e)
+    return self.mstatrtt(self.mcheckresp(func,packet,res,state,expectlen),t0)
+
+  # check if response is valid and belongs to the request; returns response or False
+  def mcheckresp(self,func,packet,res,state,expectlen=-1):
     if state==False:
-      if res==b'': self.mprinterr('recv no data!'); return False
-      else: self.mprinterr('recv checksum failed!'); return False
+      if self.rxattempt==0: return self.mfail('timeout','recv no data!')
+      else: return self.mfail('crc','recv checksum failed!')
     # check if we're getting the right response, with the right length
-    if res[0]!=packet[0]: self.mprinterr('recv response address not matching!');return False
+    if res[0]!=packet[0]: return self.mfail('badaddr','recv response address not matching!')
     if res[1]!=packet[1]:
       if res[1]&0x80==0x80:
-        self.mprinterr(self.getmodbuserrstr(func,packet,res[2]))
-      else: self.mprinterr('recv response function not matching!');return False
+        self.lastexcode=res[2]
+        if self.curstat!=None: self.curstat['excodes'][res[2]]=self.curstat['excodes'].get(res[2],0)+1
+        return self.mfail('exc',self.getmodbuserrstr(func,packet,res[2]))
+      else: return self.mfail('badfunc','recv response function not matching!')
     if func==self.MODBUS_FUNC_READMULTI16:
-      if int(res[2])!=expectlen: self.mprinterr('recv expected var length not matching!',res[2],expectlen);return False
+      if int(res[2])!=expectlen: return self.mfail('badlen','recv expected var length not matching!',res[2],expectlen)
     else:
-      if len(res)!=8: self.mprinterr('recv fixed length not matching!',res[2],8);return False
+      if len(res)!=8: return self.mfail('badlen','recv fixed length not matching!',res[2],8)
     return res
 
+  # count and print failed attempt by kind (a counter name), remembered for the error raised after last retry
+  def mfail(self,kind,*s):
+    self.mcount(kind)
+    self.failkind=kind
+    self.mprinterr(*s)
+    return False
+
+  # exception for transaction failed after all retries, by the kind of the last failure
+  def mfailerror(self):
+    msg='ERROR: MODBUS failure, too many retries. Aborting.'
+    if self.failkind=='exc': return RDModbusError(self.lastexcode,msg)
+    if self.failkind=='crc': return RDCRCError(msg)
+    if self.failkind=='timeout': return RDTimeoutError(msg)
+    return RDTransactionError(msg)
+
   # send-receive pair, calling timeoutable pair, retrying on failure
+  # retries are spaced by random backoff; with open circuit breaker, a single probe is made
   def msendrecv(self,func,packet,resplen=0,expectlen=-1):
+    self.mstatbegin(func,packet)
+    rxlen=self.mresplen(func,expectlen)
     for t in range(0,self.retries):
-      if t>0 and (self.comm.verbconn or self.comm.verbport or self.verbm): print(f'retrying ({t+1}/{self.retries})...',file=stdlog)
+      if t>0:
+        self.mcount('retry')
+        if self.comm.verbconn or self.comm.verbport or self.verbm: print(f'retrying ({t+1}/{self.retries})...',file=stdlog)
+        sleep(self.backoff(t))
+      probe=self.breakeropen()
+      self.mattempt(t,len(packet)+4,rxlen)
       resp=self.msendrecv_attempt(func,packet,resplen=resplen,expectlen=expectlen)
-      if resp != False: return resp
-    print('ERROR: MODBUS failure, too many retries. Aborting.',file=stdlog)
-    exit(10)
-    #raise(BaseException('MODBUS failure: too many retries!')) # TODO: cleaner fail
+      if self.mresult(resp): self.mcount('ok');timemark('first transaction');return resp
+      if probe or self.mfinal(): break
+    self.mcount('fail')
+    raise self.mfailerror()
 
 
-  # unpack array of bytes to array of 16bit unsigned integers
+  # unpack array of big-endian bytes to array of 16bit unsigned integers
   def get16bitarr(self,packet):
-    l=int(len(packet)/2)
-    #print(len(packet),l,'>'+'H'*l,packet)
-    a=unpack('>'+'H'*l,packet)
-    #print('array:',a)
-    return list(a)
+    a=array('H')
+    a.frombytes(packet[:len(packet)&~1])
+    if byteorder=='little': a.byteswap()
+    return a.tolist()
 
 
   # responds with array of words
@@ -377,6 +805,100 @@ modbus_test=num2packet([1,3,0,0x50,0,4])
 ##################################
 
 
+# register descriptor; scale: V/I/P for volts/amps/watts, 32 for high word of 32-bit pair, '' for raw
+class RDReg:
+  __slots__=('addr','name','mode','desc','scale')
+  def __init__(self,addr,name,mode,desc,scale=''):
+    self.addr=addr;self.name=name;self.mode=mode;self.desc=desc;self.scale=scale
+
+
+# register table compiled to indexes, name->descriptor and address->descriptor, with per-model overrides applied
+class RDRegMap:
+  compiled={} # maps by (device class, type name), tables do not change at runtime
+
+  def __init__(self,regs,scales={},overrides={}):
+    self.byaddr={}
+    for addr,a in regs.items(): self.byaddr[addr]=RDReg(addr,a[0],a[1],a[2],scales.get(addr,''))
+    for addr,a in overrides.items(): self.byaddr[addr]=RDReg(addr,*a)
+    self.byname={x.name:x for x in self.byaddr.values()}
+
+  # map of device class tables for type name, compiled on first use
+  @classmethod
+  def get(cls,psucls,typename=''):
+    key=(psucls,typename)
+    if key not in cls.compiled: cls.compiled[key]=cls(psucls.RD_REGS,psucls.RD_SCALES,psucls.RD_MODEL_REGS.get(typename,{}))
+    return cls.compiled[key]
+
+  def addr(self,name):
+    x=self.byname.get(name)
+    return None if x==None else x.addr
+
+  def name(self,addr,default=''):
+    x=self.byaddr.get(addr)
+    return default if x==None else x.name
+
+  # value of register from snapshot regs, scaled by mults {'V':vmult,'I':imult,'P':pmult}
+  def scaled(self,regs,addr,mults):
+    x=self.byaddr.get(addr)
+    if x==None or x.scale=='': return regs[addr]
+    if x.scale=='32': return (regs[addr]<<16)+regs[addr+1]
+    return regs[addr]/mults[x.scale]
+
+
+# register values of a device, unsigned 16-bit, with the time each was last read or written;
+# registers 0..len-1 are the state window as last read, the rest only as far as read or written individually
+class RDRegBank:
+  SIZE=512 # RD6024 has 512 registers
+
+  def __init__(self):
+    self.vals=array('H',bytes(2*self.SIZE))
+    self.stamps=array('d',[-1e9])*self.SIZE # monotonic time of last refresh
+    self.n=0
+
+  def __len__(self): return self.n
+
+  # single register, or list of the state window part of a slice
+  def __getitem__(self,key):
+    if isinstance(key,slice): return self.vals[slice(*key.indices(self.n))].tolist()
+    return self.vals[key]
+
+  def __setitem__(self,addr,val):
+    self.vals[addr]=val
+
+  # forget the state window
+  def clear(self):
+    self.n=0
+
+  # store state window read from start, ending there
+  def load(self,start,vals,now=None):
+    num=len(vals)
+    self.vals[start:start+num]=vals if isinstance(vals,array) else array('H',vals)
+    self.n=start+num
+    self.touch(start,num,now)
+
+  # overwrite values in the state window
+  def update(self,start,vals):
+    end=min(self.n,start+len(vals))
+    if start<end: self.vals[start:end]=array('H',vals[:end-start])
+
+  # mark as just read or written
+  def touch(self,start,num,now=None):
+    self.stamps[start:start+num]=array('d',[monotonic() if now==None else now])*num
+
+  def age(self,addr,now):
+    return now-self.stamps[addr]
+
+  # copy of the state window or its part, 2 bytes per register
+  def snapshot(self,regmap,start=0,num=None):
+    if num==None: num=self.n-start
+    return RDRegSnapshot(start,self.vals[start:start+num],regmap)
+
+  # addresses where the state window differs from snapshot
+  def diff(self,snap):
+    old=snap.values
+    return [x for x in range(snap.start,min(self.n,snap.start+len(old))) if self.vals[x]!=old[x-snap.start]]
+
+
 class PSU_RD60XX:
   # registers list borrowed from https://github.com/ShayBox/Riden
   # who borrowed it from https://github.com/Baldanos/rd6006
@@ -542,6 +1064,7 @@ class PSU_RD60XX:
   #written=False
 
   robust=False # increase timeouts, retries
+  lowlatency=False # non-blocking flush, TCP_NODELAY
   verbconn=False # debug port-level transactions
 
   bat=False   # battery relevant data
@@ -549,8 +1072,8 @@ class PSU_RD60XX:
 
   deltatime=1 # number of seconds to add to time to account for comm delay, empiric
 
-  regs=[]     # cached registers for reads
-  oldregs=[]  # saved registers for comparison
+  regs=None     # RDRegBank, cached registers for reads
+  oldregs=None  # RDRegSnapshot, saved registers for comparison
   cachereg={} # cached registers for writes, to facilitate group write
   forceread=False # force register read in sync()
 
@@ -559,6 +1082,14 @@ class PSU_RD60XX:
   imultvar=100 # instrument-dependent, fixed for now, 1000 for RD6006, 100 or 1000 for RD6012p, and so
   pmult=100 # instrument-dependent, fixed for now
   autorange=False # rd6012p current-dependent
+  # scaling classes of registers, see RDReg: V_SET,I_SET,V_OUT,I_OUT,P_OUT,V_IN,V_BAT; 32-bit SN, AH, WH; memories V,I,OVP,OCP
+  RD_SCALES={8:'V',9:'I',10:'V',11:'I',13:'P',14:'V',33:'V',1:'32',38:'32',40:'32'}
+  RD_SCALES.update({x:'VIVI'[x%4] for x in range(80,120)})
+  # per-model register differences, {typename: {number: [shortname, read/write, description, scale]}}
+  RD_MODEL_REGS={
+    'RD6012P': { 20: [ 'I_RANGE' , 'r' , 'current range, 0=6A (4 digits), 1=12A (3 digits)', '' ] },
+  }
+  regmap=None # RDRegMap for detected type
   typename=''
 
   vfmt='5.2'
@@ -570,6 +1101,7 @@ class PSU_RD60XX:
   verbauto=False # verbose autodetection
 
   readcachetimeout=1 # for automatic forced sync
+  fillfresh=1        # seconds a read register value may fill gaps in block writes
   lastreadtime=-100  # 
 
   ovp=-1
@@ -577,10 +1109,16 @@ class PSU_RD60XX:
   ovpreg=82
   ocpreg=83
 
+  modbusclass=RDModbus
+
   # initialize device when object created
   def __init__(self,comm=None):
+    self.modbus=self.modbusclass()
+    self.regmap=RDRegMap.get(type(self))
+    self.regs=RDRegBank()
+    self.cachereg={}
+    self.prefetched={}
     if comm!=None: self.setport(comm)
-    self.modbus=RDModbus()
 
   def setport(self,comm):
     self.modbus.initport(comm)
@@ -589,6 +1127,7 @@ class PSU_RD60XX:
   def connect(self):
     self.modbus.comm.connect()
     self.connected=True
+    timemark('connect')
 
   # close connection to hardware
   def close(self):
@@ -602,34 +1141,90 @@ class PSU_RD60XX:
       if self.robust:
         self.modbus.timeout=6
         self.modbus.retries=60
+        self.modbus.breaklosses=30
       if self.verbconn:
         self.modbus.comm.verbconn=True
+      if self.lowlatency:
+        self.modbus.comm.lowlatency=True
       self.connect()
 
   # store registers copy to oldregs
   def saveregs(self):
-    #print(self.regs)
-    self.oldregs=list(self.regs).copy()
+    self.oldregs=self.regs.snapshot(self.regmap)
 
   # if registers not read already, read them in
   def initregs(self):
     #print('reglen',len(self.regs),self.regs)
     if len(self.regs)==0:
       if self.verbc: print('INITREGS',file=stdlog)
+      if self.profile!=None: self.useprofile()
       self.readstate()
-      self.readovpocp() # only once, assume not changing
+      if self.profile!=None and not self.checkprofile():
+        print('WARN: device does not match cached profile, identifying again',file=stdlog)
+        self.profile=None;self.typename='';self.autorange=False;self.regs.clear()
+        self.regmap=RDRegMap.get(type(self))
+        if not self.bat_forcemode: self.bat=False
+        self.readstate()
       self.saveregs()
       #print(self.regs)
 
   # read state block of registers
   def readstate(self):
     self.initconn()
-    if len(self.regs)<4:
-      self.regs=self.modbus.modbus_readregs(0,42)
-      if (not self.bat_forcemode) and (self.getreg('BAT_MODE')>0): self.bat=True
-    else:
-      if self.bat: self.regs=self.regs[:4]+self.modbus.modbus_readregs(4,42-4) # save 8 bytes in transaction, assume type does not change
-      else:        self.regs=self.regs[:4]+self.modbus.modbus_readregs(4,20-4) # save 8 bytes in transaction, skip reading battery data
+    start,num=self.statewindow()
+    r=self.getprefetched(start,num)
+    if r==None: r=self.modbus.modbus_readregs(start,num)
+    self.regs.load(start,r)
+    self.readstatedone()
+
+  # registers to read for state: all at first, then without ID block, without battery data unless needed
+  # with cached profile, the first read includes the ID block for validation and ends at BAT_MODE
+  def statewindow(self):
+    start=0 if len(self.regs)<4 else 4 # save 8 bytes in transaction, assume type does not change
+    if self.bat or (start==0 and self.profile==None): return start,42-start
+    if start==0: return start,33 # up to BAT_MODE, battery mode is detected in every run
+    if self.autorange: return start,21-start # include I_RANGE
+    return start,20-start # skip reading battery data
+
+  ##### profile cache: identification of a device kept between runs
+
+  profile=None # cached identification from previous run, dict of strings
+
+  # identification from registers read now, in profile form; None if unknown
+  def getprofile(self):
+    if len(self.regs)<4 or self.typename in ['','[unknown]']: return None
+    a={'type':self.typename,'id':self.regs[0],'sn':(self.regs[1]<<16)+self.regs[2],'fw':self.regs[3],
+       'vmult':self.vmult,'imult':self.imult,'pmult':self.pmult}
+    return {x:str(y) for x,y in a.items()}
+
+  # set type and multipliers from cached profile, instead of autodetection
+  # a profile not matching the type table (damaged line) is dropped, the device is identified by reading then
+  def useprofile(self):
+    p=self.profile
+    try:
+      t=p['type']
+      vmult,imult,pmult=int(p['vmult']),int(p['imult']),int(p['pmult'])
+      ok=(self.RD_IDNUMS.get(int(p['id']))==t and vmult==self.RD_TYPES[t]['Vmult'] and pmult==self.pmult and
+          imult in [self.RD_TYPES[x]['Imult'] for x in [t,t+':1'] if x in self.RD_TYPES])
+    except (KeyError,ValueError): ok=False
+    if not ok:
+      print('WARN: cached profile does not match the device types table, identifying again',file=stdlog)
+      self.profile=None;return
+    self.typename=t
+    self.vmult=vmult;self.imult=self.imultvar=imult
+    self.autorange=self.typename=='RD6012P'
+    self.regmap=RDRegMap.get(type(self),self.typename)
+    self.setfmt()
+    if self.verbauto: print('AUTOCONFIG: from profile',self.typename,', Vmult =',self.vmult,', Imult =',self.imult,file=stdlog)
+
+  # first read matches the cached ID, serial number and firmware
+  def checkprofile(self):
+    p=self.getprofile()
+    return p!=None and all(p[x]==self.profile.get(x) for x in ['id','sn','fw'])
+
+  # process freshly read state registers
+  def readstatedone(self):
+    if len(self.regs)>32 and not self.bat and (not self.bat_forcemode) and (self.getreg('BAT_MODE')>0): self.bat=True
     self.written=False
     self.lastreadtime=monotonic()
     self.forceread=False
@@ -637,54 +1232,44 @@ class PSU_RD60XX:
     if self.autorange: self.setrange() # RD6006P register I_RANGE dependence
 
 
-  # resolve register name or number to number
+  # resolve register name to number, None if unknown
   def getregno(self,name):
-    for x in self.RD_REGS:
-      if self.RD_REGS[x][0]==name: return x
-    return None
+    return self.regmap.addr(name)
 
   # take string with name or number, return register number or except
   def name2reg(self,s):
-    reg=self.normreg(s)
+    reg=self.getregno(s)
     if reg==None: reg=int(s)
     return reg
 
   # return normalized register, number or name converted to number
   def normreg(self,name):
     if isinstance(name,str):
-      reg=self.getregno(name)
-      if name==None: raise(BaseException('Unknown register name: '+name))
+      reg=self.regmap.addr(name)
+      if reg==None: raise RDError('Unknown register name: '+name)
       return reg
     return name
 
-  # print single register in formatted way
-  def printreg(self,n,val,force=False):
-    name='' if n not in self.RD_REGS else self.RD_REGS[n][0]
-    desc='register '+str(n) if n not in self.RD_REGS else self.RD_REGS[n][2]
-    mode='?' if n not in self.RD_REGS else self.RD_REGS[n][1]
-    if name=='' and val==0 and not force: return
-    print(f'x{n:02x} ',end='')
-    print(f'{n:>3}  {val:>5} 0x{val:04x} {mode:<2}  {name:<14} {desc}')
-
-  # print all registers in formatted way
-  def printregs(self,start,arr,force=False):
-    self.initregs()
-    for x in range(0,len(arr)): self.printreg(start+x,arr[x],force=force)
-
-  # compare registers with saved copy in oldregisters
-  def compareregs(self):
+  # register value from cache, scaled to volts/amps/watts or joined 32-bit pair by its scaling class
+  def getscaled(self,name):
+    reg=self.normreg(name)
+    r=self.regmap.byaddr.get(reg)
+    val=self.readreg(reg)
+    if r==None or r.scale=='': return val
+    if r.scale=='32': return (val<<16)+self.readreg(reg+1)
+    return val/self.getmults()[r.scale]
+
+  # divisors of the scaling classes, for the detected type and range
+  def getmults(self):
+    return {'V':self.vmult,'I':self.imultvar,'P':self.pmult}
+
+  # addresses of registers changed since the saved copy in oldregs, without the often changing ones
+  def changedregs(self):
     self.writecache()
     if self.written: self.readstate()
     blacklist=['V_IN','EXT_C','EXT_F','KEYPAD'] # these change often, do not annoy
-    start=0
-    print()
-    print('DIFFREG:')
-    for x in range(0,len(self.oldregs)):
-      if x in self.RD_REGS and self.RD_REGS[x][0] in blacklist: continue
-      if self.regs[x]==self.oldregs[x]: continue
-      self.printreg(start+x,self.oldregs[x])
-      self.printreg(start+x,self.regs[x])
-    print()
+    if self.oldregs==None: return []
+    return [x for x in self.regs.diff(self.oldregs) if self.regmap.name(x) not in blacklist]
 
   def getfmtstr(self,range,len=7):
     if range==0: return str(len)+'.0f'
@@ -701,42 +1286,40 @@ class PSU_RD60XX:
     self.vmult=self.RD_TYPES[idstr]['Vmult']
     self.imult=self.RD_TYPES[idstr]['Imult']
     self.imultvar=self.imult
+    self.setfmt()
+    if self.verbauto: print('AUTOCONFIG: Vmult =',self.vmult,', Imult =',self.imult,', autorange' if self.autorange else '',file=stdlog)
+
+  # number formats for the multipliers
+  def setfmt(self):
     flen=7 if self.vmult>100 or self.imult>100 else 6
     self.vfmt=self.getfmtstr(self.vmult,flen)
     self.ifmt=self.getfmtstr(self.imult,flen)
     self.pfmt=self.getfmtstr(self.imult,flen)
-    if self.verbauto: print('AUTOCONFIG: Vmult =',self.vmult,', Imult =',self.imult,', autorange' if self.autorange else '',file=stdlog)
 
   def autoconfig(self):
     idnum=self.getreg('ID')
     if idnum in self.RD_IDNUMS:
       self.typename=self.RD_IDNUMS[idnum]
+      self.regmap=RDRegMap.get(type(self),self.typename)
       if self.typename=='RD6012P': print('WARN: type 6012P has two different current ranges, autorange code is not tested!',file=stderr)
       if self.typename=='RD6012P': self.autorange=True
       if self.verbauto: print('AUTOCONFIG: detected',self.typename, ' autorange enabled' if self.autorange else '')
       self.setrange()
-      if self.typename[:3]=='DPS': print('ERRTYPE: DPS devices unsupported, this one is RDS-only');exit(50)
+      if self.typename[:3]=='DPS': raise RDUnknownDeviceError('ERRTYPE: DPS devices unsupported, this one is RDS-only')
     else:
+      if idnum<60000 or idnum>60999: raise RDUnknownDeviceError(f'ERRIDENT: unknown device type ID: {idnum}') # not 60xx range of devices
       print('ERRIDENT: unknown device type ID:',idnum,file=stderr)
-      if idnum<60000 or idnum>60999: exit(50) # not 60xx range of devices
       print('WARN: voltage and current values may be order of magnitude off, assuming Vmult =',self.vmult,', Imult =',self.imult,file=stderr)
       self.typename='[unknown]'
 
 
-  # read and print registers
-  def getprintregs(self,start=0,num=42,force=False):
-    self.sync()
-    regs=self.modbus.modbus_readregs(start,num)
-    self.printregs(start,regs,force=force)
-
   # set datetime registers group to current
   def setdatetime(self):
     def getdatetime():
       from datetime import datetime,timedelta
       t=datetime.now()+timedelta(seconds=self.deltatime)
       return [t.year,t.month,t.day,t.hour,t.minute,t.second]
-    self.initconn()
-    self.modbus.modbus_writeregs(self.normreg('YEAR'),getdatetime())
+    self.writeregs('YEAR',getdatetime())
 #    self.written=True
 
   # write list of registers, start at name
@@ -744,9 +1327,9 @@ class PSU_RD60XX:
     self.initconn()
     addr=self.normreg(name)
     self.modbus.modbus_writeregs(addr,vals)
-    if addr<len(self.regs):
-      for t in range(0,len(vals)):
-        self.regs[t+addr]=vals[t]
+    self.prefetched={}
+    self.regs.update(addr,vals)
+    self.markfresh(addr,len(vals))
  #   self.written=True
 
   # write single register to MODBUS
@@ -755,21 +1338,75 @@ class PSU_RD60XX:
     if not cache:
       self.initconn()
       self.modbus.modbus_writereg(reg,val)
+      self.prefetched={}
  #     self.written=True
       if reg<len(self.regs): self.regs[reg]=val
+      self.markfresh(reg,1)
     else:
       if self.verbc: print('CACHE WRITE:',reg,'=',val,file=stdlog)
-      if (reg > len(self.regs)) or (self.regs[reg]!=val):
+      if (reg >= len(self.regs)) or (self.regs[reg]!=val):
         self.cachereg[reg]=int(val)
       elif self.verbc: print('skipped, value identical',file=stdlog)
 
 
-  # read list of registers, start at name, count of num
+  # read list of registers, start at name, count of num; from read-ahead if there
   def readregs(self,name,num):
-    self.initconn()
     reg=self.normreg(name)
+    a=self.getprefetched(reg,num)
+    if a!=None: return a
+    self.initconn()
     return self.modbus.modbus_readregs(reg,num)
 
+  ##### read-ahead of registers the commands will need, planned by their dry run
+
+  prefetched={} # addr -> value; cleared by writes and sleeps
+
+  # read registers regs, cached ones not in the state block, OVP/OCP if not known, and state block when due or forced,
+  # in merged transactions
+  # the identification read of a run is the fresh state too, forced state reads are served from it
+  def prefetch(self,regs=(),cached=(),state=False,ovpocp=False,forcestate=False):
+    first=len(self.regs)==0
+    self.initregs()
+    first=first and self.cachereg=={} # no writes after it
+    self.writecache()
+    addrs=set(regs)
+    addrs.update(x for x in cached if x>=len(self.regs))
+    if ovpocp and self.ovp<0: addrs.update([self.ovpreg,self.ocpreg])
+    state=not first and (forcestate or state and (self.forceread or monotonic()-self.lastreadtime>self.readcachetimeout))
+    if state:
+      start,num=self.statewindow()
+      addrs.update(range(start,start+num))
+    a={x:self.regs[x] for x in range(0,len(self.regs))} if first else {}
+    if len(addrs)==0:
+      if first: self.prefetched=a
+      return
+    self.initconn()
+    spans=self.mergeranges(sorted(addrs))
+    if self.verbc: print('PREFETCH:',spans,file=stdlog)
+    for lo,n in spans:
+      for t,x in enumerate(self.modbus.modbus_readregs(lo,n)): a[lo+t]=x
+    self.prefetched=a
+    if state:
+      self.regs.load(start,[a[x] for x in range(start,start+num)])
+      self.readstatedone()
+
+  # sorted addresses to (start,num) reads of max. 125 registers; a gap is read through when cheaper than another transaction
+  def mergeranges(self,addrs):
+    tframe,tbyte=self.modbus.costmodel()
+    res=[]
+    for x in addrs:
+      if res!=[]:
+        lo,n=res[-1]
+        if x-lo<125 and 2*(x-lo-n)*tbyte<tframe+13*tbyte: res[-1]=(lo,x-lo+1);continue # request 8, response 5 bytes
+      res.append((x,1))
+    return res
+
+  # registers from read-ahead, None if not all there or invalidated by a write or sleep
+  def getprefetched(self,start,num):
+    if len(self.prefetched)==0: return None
+    try: return [self.prefetched[x] for x in range(start,start+num)]
+    except KeyError: return None
+
   # read current OVP/OCP settings
   # BEWARE, may not work well when memories are used
   def readovpocp(self,usepreset=False,addr=0):
@@ -777,11 +1414,10 @@ class PSU_RD60XX:
     else: addr=4*addr
     ovp,ocp=self.readregs(self.ovpreg+4*addr,2)
     self.ovp=ovp/self.vmult
-    self.ocp=ocp/self.vmult
+    self.ocp=ocp/self.imult
 
   # read single register, from cache if in its range and not forced, else from MODBUS
   def readreg(self,name,force=False):
-    self.initconn()
     reg=self.normreg(name)
     if force or reg>=len(self.regs):
       res=self.readregs(reg,1)
@@ -796,45 +1432,63 @@ class PSU_RD60XX:
     print('CACHED:')
     for x in sorted(self.cachereg.keys()): print('   ',x,'=',self.cachereg[x])
 
-  # write single block of cached values
+  # write single block of cached values, as planned
   def writecacheblock(self,cout):
     if self.verbc: print('cacheblock:',cout,file=stdlog)
-    if len(cout)==0: return
-    sleep(0.02)
-    if len(cout)==1:
-      key=list(cout.keys())[0]
-      self.writereg(key,cout[key],cache=False)
-      return
-    a=sorted(cout.keys())
-    kmin=a[0]
-    kmax=a[len(a)-1]
-    klen=kmax-kmin+1
-    if self.verbc: print('minmax:',kmin,kmax,file=stdlog)
-    vals=list(self.regs[kmin:kmax+1])
-    if len(vals)<klen: vals=(vals+[0]*klen)[:klen]
-    if self.verbc: print('vals:',vals,file=stdlog)
-    for x in cout: vals[x-kmin]=cout[x]
-    if self.verbc: print('vals:',vals,file=stdlog)
-    self.writeregs(kmin,vals)
+    for start,vals in self.planwrites(cout):
+      if len(vals)==1: self.writereg(start,vals[0],cache=False)
+      else: self.writeregs(start,vals)
+
+  # plan writes of cached values as list of (start,vals), single registers (func 6) or blocks (func 16),
+  # cheapest by the link cost model; a block may span only registers that are fresh and writable
+  def planwrites(self,cout):
+    keys=sorted(cout)
+    if len(keys)==0: return []
+    tframe,tbyte=self.modbus.costmodel()
+    now=monotonic()
+    cost=[0]*(len(keys)+1)
+    prev=[0]*(len(keys)+1)
+    for i in range(1,len(keys)+1): # cheapest plan for keys[:i]
+      cost[i]=cost[i-1]+tframe+16*tbyte;prev[i]=i-1 # request 8, response 8 bytes
+      for j in range(i-2,-1,-1): # block keys[j]..keys[i-1]
+        if not all(self.isfresh(x,now) for x in range(keys[j]+1,keys[j+1])): break
+        n=keys[i-1]-keys[j]+1
+        if n>123: break
+        c=cost[j]+tframe+(17+2*n)*tbyte # request 9+2n, response 8 bytes
+        if c<cost[i]: cost[i]=c;prev[i]=j
+    plan=[]
+    i=len(keys)
+    while i>0:
+      j=prev[i]
+      plan.insert(0,(keys[j],[cout.get(x,self.regs[x] if x<len(self.regs) else 0) for x in range(keys[j],keys[i-1]+1)]))
+      i=j
+    if self.verbc: print('plan:',plan,file=stdlog)
+    return plan
+
+  # register value known current: writable, read or written in last fillfresh seconds
+  def isfresh(self,reg,now):
+    r=self.regmap.byaddr.get(reg)
+    return r!=None and 'w' in r.mode and reg<len(self.regs) and self.regs.age(reg,now)<=self.fillfresh
+
+  # mark registers as just read or written
+  def markfresh(self,start,num):
+    self.regs.touch(start,num)
 
   # write cached values, in two blocks, for settings and ovp/ocp
   def writecache(self):
     if self.cachereg=={}: return
-    # memory block
+    for c in self.cacheblocks(): self.writecacheblock(c)
+    self.cachereg={}
+
+  # split write cache to memory block and state block
+  def cacheblocks(self):
     clow={}
     chigh={}
     for x in self.cachereg:
       if x>=80: chigh[x]=self.cachereg[x]
       if x<=42: clow[x] =self.cachereg[x]
     if self.verbc: print('lowhi:',clow,chigh,file=stdlog)
-    self.writecacheblock(chigh)
-    self.writecacheblock(clow)
-    self.cachereg={}
-
-  # print state registrers, first 42 ones
-  def printstateregs(self):
-    self.sync()
-    self.printregs(0,self.regs)
+    return [chigh,clow]
 
   # get 32-byte value from REG_H,REG_L pair
   def getreg32(self,name):
@@ -853,10 +1507,8 @@ class PSU_RD60XX:
     fwno=self.getreg('FW')
     print(f'type={self.typename} typeID={typenum} serno={serno} fwno={fwno/100}',self.RD_TYPES[self.typename] if self.typename in self.RD_TYPES else '')
 
-  # print settings and measurements
-  def printstate(self,opts='',ovpocp=True,help=False):
-    if help:
-      print('          opts:  J=JSON, S=short (V/A only), T=show time, U=show UTC time, B=force battery');return
+  # settings and measurements from cached registers as dict; opts: J=JSON, S=short (V/A only), T=time, U=UTC time, B=force battery
+  def getstate(self,opts='',ovpocp=True):
     json=False
     short=False
     showtime=False
@@ -869,70 +1521,39 @@ class PSU_RD60XX:
     if 'T' in opts: showtime=True
     if 'U' in opts: showtimeutc=True;showtime=True
 
-    self.sync(force=True)
     a={}
     if showtime:
       from datetime import datetime
       if showtimeutc: a['time']=datetime.utcnow().isoformat()[:23]
       else: a['time']=datetime.now().isoformat()[:23]
     if not short:
-      a['Vset']= self.getreg('V_SET')/self.vmult
-      a['Iset']= self.getreg('I_SET')/self.imultvar
+      a['Vset']= self.getscaled('V_SET')
+      a['Iset']= self.getscaled('I_SET')
     if not short or not json:
       a['out'] = self.getreg('OUTPUT')
-    a['Vout']= self.getreg('V_OUT')/self.vmult
-    a['Iout']= self.getreg('I_OUT')/self.imultvar
+    a['Vout']= self.getscaled('V_OUT')
+    a['Iout']= self.getscaled('I_OUT')
     if not short:
-      a['Pout']= self.getreg('P_OUT')/self.pmult
-      a['Vin']=  self.getreg('V_IN')/self.vmult
+      a['Pout']= self.getscaled('P_OUT')
+      a['Vin']=  self.getscaled('V_IN')
     if not short or not json:
       a['cccv']= self.getreg('CV_CC')
       a['ovpocp']=self.getreg('OVP_OCP')
     if bat:
       if not short: a['isbat']=self.getreg('BAT_MODE')
-      a['Vbat']= self.getreg('V_BAT')/self.vmult
+      a['Vbat']= self.getscaled('V_BAT')
       if not short:
-        a['Ah']=   self.getreg32('AH_H')/1000
-        a['Wh']=   self.getreg32('WH_H')/1000
+        a['Ah']=   self.getscaled('AH_H')/1000
+        a['Wh']=   self.getscaled('WH_H')/1000
     if not short:
       if ovpocp:
+        if self.ovp<0: self.readovpocp() # first use only, assume not changing
         a['OVP']=self.ovp
         a['OCP']=self.ocp
       a['tempint']=self.getreg('INT_C')
-    istempext=False
-    if self.bat and self.getreg('EXT_C_S')==0: istempext=True;a['tempext']=self.getreg('EXT_C')
+    if self.bat and self.getreg('EXT_C_S')==0: a['tempext']=self.getreg('EXT_C')
     if self.autorange: a['autorange']=self.getreg('I_RANGE')
-    if json:
-      from json import dumps
-      print(dumps(a))
-    else:
-      if showtimeutc: print(f'time = {a["time"]} UTC')
-      elif showtime: print(f'time = {a["time"]}')
-      if not short:
-        print(f'Vin  = {a["Vin"]:7.2f} v',end='')
-        print(f'    tempin = {a["tempint"]:>2} \'c',end='')
-        if istempext: tempextstr=f'{a["tempext"]:>2} \'c'
-        else: tempextstr='(disconnected)'
-        print(f'    tempext = {tempextstr}' if self.bat else '')
-        print(f'Vset = {a["Vset"]:{self.vfmt}} v',end='')
-        print(f'    OVP = {a["OVP"]:{self.vfmt}} v' if ovpocp else '')
-        print(f'Iset = {a["Iset"]:{self.ifmt}} a',end='')
-        print(f'    OCP = {a["OCP"]:{self.ifmt}} a' if ovpocp else '')
-      if a['out']>0: print('OUTPUT ENABLED')
-      else: print('OUTPUT DISABLED')
-      if a['cccv']>0: print('CURRENT MODE')
-      if a['ovpocp']>0: print('OVP_OCP PROTECTION ACTIVE')
-      if 'Vbat' in a: print(f'Vbat = {a["Vbat"]:{self.vfmt}} v')
-      print(f'Vout = {a["Vout"]:{self.vfmt}} v')
-      print(f'Iout = {a["Iout"]:{self.ifmt}} a')
-      if 'Pout' in a: print(f'Pout = {a["Pout"]:{self.pfmt}} w')
-      if self.bat:
-        if 'Ah' in a: print(f'Ahour = {a["Ah"]} Ah')
-        if 'Wh' in a: print(f'Whour = {a["Wh"]} Wh')
-
-  # print memories M0..M9
-  def printmem(self):
-    self.getprintregs('M0_V',10*4,force=False)
+    return a
 
   # synchronize states; flush write cache, do initial register read if needed, read state if needed
   def sync(self,force=False):
@@ -944,25 +1565,12 @@ class PSU_RD60XX:
 
   # read four values from memory Mx (volts, amps, ovp, ocp)
   def readmem(self,addr):
-    self.initconn()
-    regs=self.modbus.modbus_readregs(self.normreg('M0_V')+4*addr,4)
+    regs=self.readregs(self.normreg('M0_V')+4*addr,4)
     #print('memory',addr,'=',regs)
     return regs
 
-  def printmemarr(self,addr,a):
-    #a=self.readmem(addr)
-    print(f'M{addr}: {a[0]/self.vmult:>6} v  {a[1]/self.imult:>6} a  {a[2]/self.vmult:>6} v ovp  {a[3]/self.imult:>6} a ocp')
-
-  def printmems(self):
-    self.initconn()
-    regs=self.modbus.modbus_readregs(self.normreg('M0_V'),4*10)
-    print('PRESETS:')
-    for t in range(0,10): self.printmemarr(t,regs[4*t:])
-    print('Current:',self.getreg('PRESET'))
-
   def setmemraw(self,addr,arr): # expects [volt,amp,ovolt,oamp]
-    self.initconn()
-    self.modbus.modbus_writeregs(self.normreg('M0_V')+4*addr,arr)
+    self.writeregs(self.normreg('M0_V')+4*addr,arr)
     self.readmem(addr)
 
   # set memory to real values, convert from float to int
@@ -1030,6 +1638,539 @@ class PSU_RD60XX:
 # TODO: usemem() with correct ovp/ocp setting copy
 
 
+##############################################
+##
+##  LIBRARY INTERFACE, for use from other programs
+##
+##############################################
+
+# connection is kept open between calls; results are returned, failures raise RDError subclasses
+# usage:
+#   with RD60(host='10.0.1.15') as psu:
+#     psu.set(volt=5,amp=0.5,output=1)
+#     st=psu.state()
+#     print(st.Vout,st.Iout)
+
+
+# settings and measurements at one reading, in volts/amps/watts; names as in JSON state, None if not read
+class RDState:
+  FIELDS=('time','Vset','Iset','out','Vout','Iout','Pout','Vin','cccv','ovpocp','isbat','Vbat','Ah','Wh','OVP','OCP','tempint','tempext','autorange')
+  __slots__=FIELDS
+
+  def __init__(self,a):
+    for x in self.FIELDS: setattr(self,x,a.get(x))
+
+  def asdict(self):
+    return {x:getattr(self,x) for x in self.FIELDS if getattr(self,x)!=None}
+
+  def __repr__(self):
+    return 'RDState('+', '.join(f'{x}={y!r}' for x,y in self.asdict().items())+')'
+
+
+# raw register values read at one time, indexed by address or name
+class RDRegSnapshot:
+  __slots__=('time','start','values','regmap')
+
+  def __init__(self,start,values,regmap,time=None):
+    self.start=start
+    self.values=values
+    self.regmap=regmap
+    self.time=monotonic() if time==None else time
+
+  def __getitem__(self,key):
+    addr=self.regmap.addr(key) if isinstance(key,str) else key
+    if addr==None or addr<self.start or addr>=self.start+len(self.values): raise KeyError(key)
+    return self.values[addr-self.start]
+
+  def __len__(self): return len(self.values)
+
+  # (address, name, value) of all registers
+  def items(self):
+    return [(self.start+t,self.regmap.name(self.start+t),x) for t,x in enumerate(self.values)]
+
+
+class RD60:
+  # device on TCP host:port or serial port serport; or on given port object (SimPort, ...); or over a driver object psu set up already
+  def __init__(self,host=None,port=DEFAULT_TCPPORT,serport=None,baudrate=DEFAULT_BAUDRATE,addr=DEFAULT_MODBUS_ADDR,comm=None,robust=False,lowlatency=False,psu=None):
+    if psu!=None: self.psu=psu;return
+    if comm==None:
+      if serport!=None: comm=LowLevelSerPort(serport,baudrate)
+      elif host!=None: comm=LowLevelTcpPort(host,port)
+      else: raise ValueError('host or serport needed')
+    self.psu=PSU_RD60XX(comm)
+    self.psu.modbus.addr=addr
+    self.psu.robust=robust
+    self.psu.lowlatency=lowlatency
+
+  # connect and identify; done by first use too
+  def open(self):
+    self.psu.initregs()
+    return self
+
+  # write pending settings, close connection
+  def close(self):
+    try:
+      if self.psu.connected: self.psu.writecache()
+    finally: self.psu.close()
+
+  def __enter__(self): return self.open()
+
+  def __exit__(self,*exc): self.close()
+
+  @property
+  def typename(self):
+    self.psu.initregs()
+    return self.psu.typename
+
+  # identification: type, ID, serial number, firmware version
+  def ident(self):
+    self.psu.initregs()
+    return {'type':self.psu.typename,'id':self.psu.getreg('ID'),'sn':self.psu.getreg32('SN_H'),'fw':self.psu.getreg('FW')/100}
+
+  # fresh state, or with fresh=False from the registers read within the cache timeout; OVP/OCP are read on first call only
+  # bat: battery data even if battery mode is off, utc: time in UTC, short: output values (and flags) only, fewer registers
+  def state(self,fresh=True,ovpocp=True,bat=False,utc=False,short=False):
+    self.psu.sync(force=fresh)
+    return RDState(self.psu.getstate('T'+'B'*bat+'U'*utc+'S'*short,ovpocp=ovpocp))
+
+  # output voltage and current only, one short transaction
+  def measure(self):
+    self.psu.initregs()
+    v,i=self.psu.readregs('V_OUT',2)
+    return v/self.psu.vmult,i/self.psu.imultvar
+
+  # raw registers, num from start (address or name); cached: from the state registers read within the cache timeout if they cover them
+  def readregs(self,start=0,num=42,cached=False):
+    self.psu.initregs()
+    start=self.psu.normreg(start)
+    if cached:
+      self.psu.sync()
+      if start+num<=len(self.psu.regs): return self.psu.regs.snapshot(self.psu.regmap,start,num)
+    else: self.psu.writecache()
+    return RDRegSnapshot(start,self.psu.readregs(start,num),self.psu.regmap)
+
+  regs=readregs
+
+  # fresh state window, compact copy to keep; changed() lists addresses differing from it later
+  def snapshot(self):
+    self.psu.sync(force=True)
+    return self.psu.regs.snapshot(self.psu.regmap)
+
+  def changed(self,snap):
+    self.psu.sync(force=True)
+    return self.psu.regs.diff(snap)
+
+  # write raw register immediately
+  def writereg(self,name,val):
+    self.psu.initregs()
+    self.psu.writereg(name,int(val),cache=False)
+
+  # change given settings, written together; output: 1/0 or True/False
+  def set(self,volt=None,amp=None,ovp=None,ocp=None,output=None):
+    self.psu.initregs()
+    if volt!=None: self.psu.setvolt(volt)
+    if amp!=None: self.psu.setamp(amp)
+    if ovp!=None: self.psu.setovp(ovp)
+    if ocp!=None: self.psu.setocp(ocp)
+    if output!=None: self.psu.writereg('OUTPUT',int(bool(output)))
+    self.psu.writecache()
+
+  def on(self): self.set(output=1)
+
+  def off(self): self.set(output=0)
+
+  # memories M0..M9 as [volts, amps, OVP volts, OCP amps]
+  def mems(self):
+    self.psu.initregs()
+    regs=self.psu.readregs('M0_V',4*10)
+    return [[regs[t]/self.psu.vmult,regs[t+1]/self.psu.imult,regs[t+2]/self.psu.vmult,regs[t+3]/self.psu.imult] for t in range(0,40,4)]
+
+  def setmem(self,addr,volt,amp,ovp,ocp):
+    self.psu.initregs()
+    self.psu.setmem(addr,[volt,amp,ovp,ocp])
+
+
+##############################################
+##
+##  ASYNCIO VARIANTS, for many devices in one process
+##
+##############################################
+
+# same protocol and register logic as above, with the I/O methods as coroutines;
+# errors raise RDError as in the blocking classes, so one failing device does not stop the others
+# usage:
+#   psus=[AsyncPSU_RD60XX(AsyncTcpPort(host,8888)) for host in hosts]
+#   states=asyncio.run(AsyncPSU_RD60XX.pollmany(psus))
+
+
+class AsyncTcpPort(LowLevelTcpPort):
+
+  async def connect(self):
+    import asyncio,socket
+    loop=asyncio.get_running_loop()
+    if self.verbconn: print('ASOCK:connecting to',self.ipaddr,':',self.ipport,file=stdlog)
+    for t in range(0,self.connretries):
+      self.sock=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.sock.setblocking(False)
+      try:
+        if t>0: print('ASOCK:connection retrying...',t,file=stdlog)
+        await asyncio.wait_for(loop.sock_connect(self.sock,(self.ipaddr,self.ipport)),self.timeout)
+        self.connected=True
+        break
+      except Exception as e:
+        self.sock.close()
+        print('ASOCKCONNERR:',self.ipaddr,e,file=stdlog)
+        await asyncio.sleep(min(0.5+t,5)) # increase retries delay, max. 5s
+    if not self.connected:
+      raise RDConnectError(f'ERRSOCKCONN: cannot connect to {self.ipaddr}:{self.ipport} - too many retries')
+    if self.lowlatency: self.sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+    if self.verbconn: print('ASOCK:connected',file=stdlog)
+    return self.sock
+
+  async def close(self):
+    if self.verbconn: print('ASOCK:closed',file=stdlog)
+    self.sock.close()
+    self.connected=False
+
+  # socket stays non-blocking, timeouts are applied by wait_for
+  def settimeout(self,timeout):
+    self.timeout=timeout
+
+  async def reconnectafter(self,e):
+    print('ASOCK:ERR:',self.ipaddr,e,file=stderr)
+    if not self.reconnect: raise e
+    self.sock.close()
+    self.connected=False
+    await self.connect()
+
+  async def send(self,raw,showpacket=None):
+    import asyncio
+    if showpacket!=None and self.verbport: showpacket(raw,name='ASOCK:SEND',check=False)
+    try: await asyncio.wait_for(asyncio.get_running_loop().sock_sendall(self.sock,raw),self.timeout)
+    except (OSError,asyncio.TimeoutError) as e: await self.reconnectafter(e)
+
+  # receive into buffer whatever the socket gives; returns count, 0 on timeout or error (after reconnect)
+  async def recvinto(self,view,showpacket=None):
+    import asyncio
+    try: n=await asyncio.wait_for(asyncio.get_running_loop().sock_recv_into(self.sock,view),self.timeout)
+    except asyncio.TimeoutError: return 0
+    except OSError as e: await self.reconnectafter(e);return 0
+    if showpacket!=None and self.verbport: showpacket(bytes(view[:n]),name='ASOCK:RECV',check=False)
+    return n
+
+  # discard stale data; waits flushtimeout for it unless in lowlatency mode
+  async def recvflush(self):
+    import asyncio
+    n=self.recvflushnow()
+    if n==0 and not self.lowlatency:
+      try: n=len(await asyncio.wait_for(asyncio.get_running_loop().sock_recv(self.sock,1024),self.flushtimeout))
+      except (OSError,asyncio.TimeoutError): n=0
+      self.flushedbytes+=n
+    return n
+
+
+class AsyncRDModbus(RDModbus):
+
+  async def msend(self,packet):
+    if await self.comm.recvflush()>0: self.mprinterr('nonzero recv flush')
+    packet=self.mprepare(packet)
+    t0=monotonic()
+    await self.comm.send(packet,self.showpacket)
+    return t0
+
+  async def mrecvframe(self,func,expectlen=-1):
+    deadline=monotonic()+self.attempttimeout
+    while True:
+      packet=self.mscanframe(func,expectlen)
+      if packet!=None: return packet
+      if monotonic()>deadline: return b''
+      n=await self.comm.recvinto(self.rxview[self.rxlen:],self.showpacket)
+      if n==0: return b''
+      self.rxlen+=n
+      self.rxattempt+=n
+      self.mcount('rxbytes',n)
+
+  async def mrecv(self,func,expectlen=-1):
+    packet=await self.mrecvframe(func,expectlen)
+    if self.verbm: self.showpacket(packet,name='MODBUS:RECV',check=True)
+    return packet,packet!=b''
+
+  async def msendrecv_attempt(self,func,packet,resplen=0,expectlen=-1):
+    import asyncio
+    packet=self.mframe(func,packet)
+    wait=self.gapwait()
+    if wait>0: await asyncio.sleep(wait)
+    t0=await self.msend(packet)
+    try:
+      res,state=await self.mrecv(func,expectlen)
+    except Exception as e: return self.mfail('error','exception:',e)
+    return self.mstatrtt(self.mcheckresp(func,packet,res,state,expectlen),t0)
+
+  async def msendrecv(self,func,packet,resplen=0,expectlen=-1):
+    import asyncio
+    self.mstatbegin(func,packet)
+    rxlen=self.mresplen(func,expectlen)
+    for t in range(0,self.retries):
+      if t>0:
+        self.mcount('retry')
+        if self.comm.verbconn or self.comm.verbport or self.verbm: print(f'retrying ({t+1}/{self.retries})...',file=stdlog)
+        await asyncio.sleep(self.backoff(t))
+      probe=self.breakeropen()
+      self.mattempt(t,len(packet)+4,rxlen)
+      resp=await self.msendrecv_attempt(func,packet,resplen=resplen,expectlen=expectlen)
+      if self.mresult(resp): self.mcount('ok');return resp
+      if probe or self.mfinal(): break
+    self.mcount('fail')
+    raise self.mfailerror()
+
+  async def modbus_readregs(self,start,num):
+    if self.verbm: print('MODBUS:CMND:READREGS',start,num,file=stdlog)
+    res=await self.msendrecv(self.MODBUS_FUNC_READMULTI16,pack('>HH',start,num),expectlen=num*2)
+    return self.get16bitarr(res[3:-2])
+
+  async def modbus_writereg(self,start,val):
+    if isinstance(val,float): val=int(val)
+    if self.verbm: print('MODBUS:CMND:WRITEREG',start,'=',val,file=stdlog)
+    return await self.msendrecv(self.MODBUS_FUNC_WRITESINGLE16,pack('>HH',start,val),resplen=8)
+
+  async def modbus_writeregs(self,start,valarr):
+    if self.verbm: print('MODBUS:CMND:WRITEREGS',start,'=',valarr,file=stdlog)
+    packet=pack('>HHB'+len(valarr)*'H',start,len(valarr),2*len(valarr),*valarr)
+    return await self.msendrecv(self.MODBUS_FUNC_WRITEMULTI16,packet,resplen=8)
+
+
+class AsyncPSU_RD60XX(PSU_RD60XX):
+  modbusclass=AsyncRDModbus
+
+  async def connect(self):
+    await self.modbus.comm.connect()
+    self.connected=True
+
+  async def close(self):
+    if self.connected:
+      await self.modbus.comm.close()
+      self.connected=False
+
+  async def initconn(self):
+    if not self.connected:
+      if self.robust:
+        self.modbus.timeout=6
+        self.modbus.retries=60
+        self.modbus.breaklosses=30
+      if self.verbconn: self.modbus.comm.verbconn=True
+      if self.lowlatency: self.modbus.comm.lowlatency=True
+      await self.connect()
+
+  async def __aenter__(self):
+    await self.initregs()
+    return self
+
+  async def __aexit__(self,*exc):
+    await self.close()
+
+  async def initregs(self):
+    if len(self.regs)==0:
+      await self.readstate()
+      await self.readovpocp()
+      self.saveregs()
+
+  async def readstate(self):
+    await self.initconn()
+    start,num=self.statewindow()
+    self.regs.load(start,await self.modbus.modbus_readregs(start,num))
+    self.readstatedone() # autoconfig, ranges; from cached registers only
+
+  async def readregs(self,name,num):
+    await self.initconn()
+    return await self.modbus.modbus_readregs(self.normreg(name),num)
+
+  async def readovpocp(self,addr=0):
+    ovp,ocp=await self.readregs(self.ovpreg+4*addr,2)
+    self.ovp=ovp/self.vmult
+    self.ocp=ocp/self.imult
+
+  # registers outside of the state block have to be read explicitly with readregs()
+  def readreg(self,name,force=False):
+    reg=self.normreg(name)
+    if force or reg>=len(self.regs): raise LookupError(f'register {name} not cached, use readregs()')
+    return self.regs[reg]
+
+  async def writeregs(self,name,vals):
+    await self.initconn()
+    addr=self.normreg(name)
+    await self.modbus.modbus_writeregs(addr,vals)
+    self.regs.update(addr,vals)
+    self.markfresh(addr,len(vals))
+
+  # cached writes only collect values; writecache() or sync() sends them
+  def writereg(self,name,val,cache=True):
+    if not cache: raise ValueError('uncached write needs writeregs()')
+    super().writereg(name,val)
+
+  async def writecache(self):
+    if self.cachereg=={}: return
+    for c in self.cacheblocks():
+      for start,vals in self.planwrites(c):
+        if len(vals)==1:
+          await self.initconn()
+          await self.modbus.modbus_writereg(start,vals[0])
+          if start<len(self.regs): self.regs[start]=vals[0]
+          self.markfresh(start,1)
+        else: await self.writeregs(start,vals)
+    self.cachereg={}
+
+  async def sync(self,force=False):
+    await self.initregs()
+    await self.writecache()
+    if force or self.forceread or monotonic()-self.lastreadtime>self.readcachetimeout: await self.readstate()
+
+  # fresh state as dict, same opts as getstate
+  async def state(self,opts='J'):
+    await self.sync(force=True)
+    return self.getstate(opts)
+
+  async def setvolt(self,val,rel=False):
+    await self.initregs()
+    if rel: val=self.getreg('V_SET')/self.vmult+val
+    self.writereg('V_SET',self.vmult*val)
+    await self.sync()
+
+  async def setamp(self,val,rel=False):
+    await self.initregs()
+    if rel: val=self.getreg('I_SET')/self.imultvar+val
+    self.writereg('I_SET',self.imultvar*val)
+    await self.sync()
+
+  async def setON(self):
+    await self.initregs()
+    self.writereg('OUTPUT',1)
+    await self.sync()
+
+  async def setOFF(self):
+    await self.initregs()
+    self.writereg('OUTPUT',0)
+    await self.sync()
+
+  # poll state of all devices concurrently; failed device gives its exception instead of state
+  @staticmethod
+  async def pollmany(psus,opts='J'):
+    import asyncio
+    return await asyncio.gather(*[p.state(opts) for p in psus],return_exceptions=True)
+
+
+
+###############################
+##
+##  BINARY REGISTER LOG
+##
+###############################
+
+# append-only log of state register snapshots, for long captures
+# header: magic, type name, vmult, imult, imult in high range (RD6012P), pmult, flags, first register, register count
+# record: little-endian double UNIX time, then the registers as read, unsigned 16-bit
+class RDRegLog:
+  MAGIC=b'RD60LOG1'
+  HEAD=Struct('<8s16sIIIIHHH')
+  FLAG_AUTORANGE=1
+
+  # open for appending; a new file gets header with the window of the registers read so far, existing one must match device
+  def __init__(self,filename,psu):
+    self.filename=filename
+    self.f=open(filename,'ab')
+    if self.f.tell()==0:
+      self.start=4 # ID block does not change
+      self.num=len(psu.regs)-self.start
+      imult2=psu.RD_TYPES.get(psu.typename+':1',{}).get('Imult',psu.imult)
+      self.f.write(self.HEAD.pack(self.MAGIC,psu.typename.encode(),psu.vmult,psu.imult,imult2,psu.pmult,
+                                  self.FLAG_AUTORANGE if psu.autorange else 0,self.start,self.num))
+    else:
+      with open(filename,'rb') as f: h=self.HEAD.unpack(f.read(self.HEAD.size))
+      if h[0]!=self.MAGIC: raise ValueError(f'{filename}: not a register log')
+      typename=h[1].rstrip(b'\0').decode()
+      if typename!=psu.typename: raise ValueError(f'{filename}: logged from {typename}, device is {psu.typename}')
+      self.start,self.num=h[7],h[8]
+    self.rec=Struct('<d'+'H'*self.num)
+
+  # append snapshot of the cached registers; registers not read lately are logged as 0
+  def append(self,psu):
+    from time import time
+    vals=psu.regs[self.start:self.start+self.num]
+    self.f.write(self.rec.pack(time(),*(vals+[0]*(self.num-len(vals)))))
+    self.f.flush()
+
+  def close(self):
+    self.f.close()
+
+
+# memory-mapped reader of the register log; only the pages of the accessed data are read from disk
+# columns are NumPy arrays when NumPy is installed, lists otherwise
+class RDRegLogReader:
+  def __init__(self,filename):
+    import mmap
+    self.f=open(filename,'rb')
+    self.mm=mmap.mmap(self.f.fileno(),0,access=mmap.ACCESS_READ)
+    h=RDRegLog.HEAD.unpack_from(self.mm,0)
+    if h[0]!=RDRegLog.MAGIC: raise ValueError(f'{filename}: not a register log')
+    self.typename=h[1].rstrip(b'\0').decode()
+    self.vmult,self.imult,self.imult2,self.pmult,self.flags,self.start,self.num=h[2:]
+    self.regmap=RDRegMap.get(PSU_RD60XX,self.typename)
+    self.rec=Struct('<d'+'H'*self.num)
+    self.count=(len(self.mm)-RDRegLog.HEAD.size)//self.rec.size # incomplete last record, if any, is ignored
+
+  def __len__(self): return self.count
+  def __enter__(self): return self
+  def __exit__(self,*args): self.close()
+
+  def close(self):
+    try: self.mm.close()
+    except BufferError: pass # NumPy arrays still reference the map, it goes with them
+    self.f.close()
+
+  # record i as (time, list of raw registers)
+  def record(self,i):
+    a=self.rec.unpack_from(self.mm,RDRegLog.HEAD.size+i*self.rec.size)
+    return a[0],list(a[1:])
+
+  # names of available columns: time, register names of the window, Ah/Wh (32-bit pairs) when logged
+  def columns(self):
+    res=['time']+[self.regmap.name(x,str(x)) for x in range(self.start,self.start+self.num)]
+    return res+[x for x,y in [('Ah',38),('Wh',40)] if y+1<self.start+self.num]
+
+  # column by name or register number, raw=False scales to volts/amps/watts and Ah/Wh
+  def column(self,name,raw=False):
+    try: import numpy
+    except ImportError: numpy=None
+    if name=='time': return self.getcol(numpy,-1)
+    if name in ['Ah','Wh']:
+      r=38 if name=='Ah' else 40
+      hi,lo=self.getcol(numpy,r-self.start),self.getcol(numpy,r+1-self.start)
+      if numpy!=None: return (hi.astype(numpy.uint32)<<16|lo)/(1 if raw else 1000)
+      return [(h<<16|l)/(1 if raw else 1000) for h,l in zip(hi,lo)]
+    if isinstance(name,str) and name.isdigit(): name=int(name) # unnamed registers
+    reg=name if isinstance(name,int) else self.regmap.addr(name)
+    if reg==None or reg<self.start or reg>=self.start+self.num: raise KeyError(f'register {name} not in log')
+    col=self.getcol(numpy,reg-self.start)
+    kind=self.regmap.byaddr[reg].scale if reg in self.regmap.byaddr else ''
+    if raw or kind not in ['V','I','P']: return col
+    if kind=='I' and self.flags&RDRegLog.FLAG_AUTORANGE and 20 in range(self.start,self.start+self.num):
+      rng=self.getcol(numpy,20-self.start)
+      if numpy!=None: return col/numpy.where(rng>0,self.imult2,self.imult)
+      return [x/(self.imult2 if r>0 else self.imult) for x,r in zip(col,rng)]
+    m={'V':self.vmult,'I':self.imult,'P':self.pmult}[kind]
+    if numpy!=None: return col/m
+    return [x/m for x in col]
+
+  # raw column k of the registers (-1 for time), strided view into the map or list
+  def getcol(self,numpy,k):
+    if numpy!=None:
+      dt=numpy.dtype([('time','<f8'),('regs','<u2',(self.num,))])
+      a=numpy.frombuffer(self.mm,dtype=dt,count=self.count,offset=RDRegLog.HEAD.size)
+      return a['time'] if k<0 else a['regs'][:,k]
+    with memoryview(self.mm)[RDRegLog.HEAD.size:RDRegLog.HEAD.size+self.count*self.rec.size] as m:
+      return [a[k+1] for a in self.rec.iter_unpack(m)]
+
+
+
 ###############################
 ##
 ##  HIGH LEVEL COMMAND HANDLING
@@ -1037,15 +2178,75 @@ class PSU_RD60XX:
 ###############################
 
 
+# period timer locked to monotonic() deadlines, so the work done in each iteration does not add to the period
+# on overrun, policy SKIP drops the deadlines already passed, CATCHUP runs them late, back to back
+class Ticker:
+  def __init__(self,period,policy='SKIP'):
+    self.period=period
+    self.catchup=policy=='CATCHUP'
+    self.start=monotonic()
+    self.deadline=self.start
+    self.ticks=0
+    self.missed=0 # deadlines overrun by a whole period (skipped, or run late)
+    self.latesum=0.0;self.latesq=0.0;self.latemax=0.0 # start time after deadline, for jitter
+
+  # wait for the next deadline
+  def wait(self):
+    self.ticks+=1
+    if self.period<=0: return
+    now=monotonic()
+    if now>self.deadline+self.period:
+      n=int((now-self.deadline)/self.period)
+      if self.catchup: self.missed+=1 # this one runs late, the passed ones are counted when their turn comes
+      else: self.missed+=n;self.deadline+=n*self.period
+    if now<self.deadline: sleep(self.deadline-now)
+    late=monotonic()-self.deadline
+    self.latesum+=late;self.latesq+=late*late;self.latemax=max(self.latemax,late)
+    self.deadline+=self.period
+
+  # wait for deadline t seconds from start, for schedules of irregular points (period None);
+  # a point late past the next one at nextt is missed, False when skipping it
+  def waitfor(self,t,nextt=None):
+    self.deadline=self.start+t
+    now=monotonic()
+    if nextt!=None and now>self.start+nextt:
+      self.missed+=1
+      if not self.catchup: return False
+    if now<self.deadline: sleep(self.deadline-now)
+    self.ticks+=1
+    late=monotonic()-self.deadline
+    self.latesum+=late;self.latesq+=late*late;self.latemax=max(self.latemax,late)
+    return True
+
+  # start time jitter against deadlines, in ms
+  def jitterstr(self):
+    if self.ticks==0 or self.period!=None and self.period<=0: return 'jitter -'
+    avg=self.latesum/self.ticks
+    std=max(0,self.latesq/self.ticks-avg*avg)**0.5
+    return f'jitter avg {1000*avg:.3f} std {1000*std:.3f} max {1000*self.latemax:.3f} ms'
+
+  def report(self,name):
+    return f'{name}: {self.ticks} iterations in {monotonic()-self.start:.3f} s, {self.missed} missed deadlines ({"caught up" if self.catchup else "skipped"}), {self.jitterstr()}'
+
 
 class PowerSupply:
 
   verbcmd=False
-  rdpsu=PSU_RD60XX()
+  rdpsu=None
   qend='\n'
   #qend=' '
   lastcmd=''
 
+  def __init__(self):
+    self.rdpsu=PSU_RD60XX() # for the dry run; replaced by the connected one in initport
+
+  # library interface over rdpsu, for the queries; the CLI only formats what it returns
+  @property
+  def dev(self):
+    if self._dev==None or self._dev.psu is not self.rdpsu: self._dev=RD60(psu=self.rdpsu)
+    return self._dev
+  _dev=None
+
   # return float and if it is absolute or relative
   def floatrel(self,val):
     rel=False
@@ -1053,6 +2254,95 @@ class PowerSupply:
     f=float(val)
     return f,rel
 
+  # action of a command: kept as its compiled operation in dry run, done now in live run
+  def act(self,dryrun,fn):
+    if dryrun: self.curop=fn
+    else: fn()
+
+  # print register value for the Q-queries, scaled by div, in thousandths if milli
+  def printreg(self,reg,div=None,milli=False):
+    val=self.dev.readregs(reg,1,cached=True)[reg]
+    if div!=None: val=val/div
+    if milli: val=int(1000*val)
+    print(val,end=self.qend)
+
+  def writereg(self,reg,val):
+    print('REGISTER WRITE:',reg,'=',val)
+    self.rdpsu.writereg(reg,val,cache=False) # no caching, immediate write
+
+  def pause(self,secs):
+    self.rdpsu.sync();sleep(secs);self.rdpsu.forceread=True;self.rdpsu.prefetched={}#self.rdpsu.written=True
+
+  # print settings and measurements; opts: J=JSON, S=short (V/A only), T=show time, U=show UTC time, B=force battery
+  def printstate(self,opts):
+    opts=opts.upper()
+    json='J' in opts
+    short='S' in opts
+    showtime='T' in opts or 'U' in opts
+    psu=self.rdpsu
+
+    st=self.dev.state(ovpocp=not short,bat='B' in opts,utc='U' in opts,short=short)
+    keep=['Vout','Iout','Vbat','tempext','autorange']+([] if json else ['out','cccv','ovpocp']) # short
+    a={x:y for x,y in st.asdict().items() if (showtime if x=='time' else not short or x in keep)}
+    if json:
+      from json import dumps
+      print(dumps(a))
+    else:
+      if 'U' in opts: print(f'time = {a["time"]} UTC')
+      elif 'time' in a: print(f'time = {a["time"]}')
+      if not short:
+        print(f'Vin  = {a["Vin"]:7.2f} v',end='')
+        print(f'    tempin = {a["tempint"]:>2} \'c',end='')
+        if 'tempext' in a: tempextstr=f'{a["tempext"]:>2} \'c'
+        else: tempextstr='(disconnected)'
+        print(f'    tempext = {tempextstr}' if psu.bat else '')
+        print(f'Vset = {a["Vset"]:{psu.vfmt}} v',end='')
+        print(f'    OVP = {a["OVP"]:{psu.vfmt}} v')
+        print(f'Iset = {a["Iset"]:{psu.ifmt}} a',end='')
+        print(f'    OCP = {a["OCP"]:{psu.ifmt}} a')
+      if a['out']>0: print('OUTPUT ENABLED')
+      else: print('OUTPUT DISABLED')
+      if a['cccv']>0: print('CURRENT MODE')
+      if a['ovpocp']>0: print('OVP_OCP PROTECTION ACTIVE')
+      if 'Vbat' in a: print(f'Vbat = {a["Vbat"]:{psu.vfmt}} v')
+      print(f'Vout = {a["Vout"]:{psu.vfmt}} v')
+      print(f'Iout = {a["Iout"]:{psu.ifmt}} a')
+      if 'Pout' in a: print(f'Pout = {a["Pout"]:{psu.pfmt}} w')
+      if psu.bat:
+        if 'Ah' in a: print(f'Ahour = {a["Ah"]} Ah')
+        if 'Wh' in a: print(f'Whour = {a["Wh"]} Wh')
+
+  # print single register in formatted way, unnamed zero ones only if force
+  def printregline(self,n,val,force=False):
+    r=self.rdpsu.regmap.byaddr.get(n)
+    name='' if r==None else r.name
+    desc='register '+str(n) if r==None else r.desc
+    mode='?' if r==None else r.mode
+    if name=='' and val==0 and not force: return
+    print(f'x{n:02x} ',end='')
+    print(f'{n:>3}  {val:>5} 0x{val:04x} {mode:<2}  {name:<14} {desc}')
+
+  # read and print registers
+  def printregs(self,start=0,num=42,force=False):
+    for n,name,val in self.dev.readregs(start,num).items(): self.printregline(n,val,force=force)
+
+  # registers changed since the first read, old and new value
+  def printregsdiff(self):
+    psu=self.rdpsu
+    psu.sync()
+    print()
+    print('DIFFREG:')
+    for x in psu.changedregs():
+      self.printregline(x,psu.oldregs[x])
+      self.printregline(x,psu.regs[x])
+    print()
+
+  # print memories M0..M9 and the selected one
+  def printmems(self):
+    print('PRESETS:')
+    for t,a in enumerate(self.dev.mems()): print(f'M{t}: {a[0]:>6} v  {a[1]:>6} a  {a[2]:>6} v ovp  {a[3]:>6} a ocp')
+    print('Current:',self.dev.readregs('PRESET',1,cached=True)['PRESET'])
+
 
 
   # handle individual command; dryrun only checks validity, help only prints command description
@@ -1061,6 +2351,7 @@ class PowerSupply:
     cmdarr=(cmdorig+':::').split(':') # enforce minimal length of parameters array
     cmd=cmdarr[0].upper()
     self.lastcmd=cmd
+    self.curneeds=self.newneeds() if dryrun and not help else None
     if cmd=='': return True
 
     # help
@@ -1076,28 +2367,36 @@ class PowerSupply:
     # single-word queries
     elif cmd=='QV':
       if help: print('  QV             query actual voltage');return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg('V_OUT')/self.rdpsu.vmult,end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('V_OUT',self.rdpsu.vmult))
     elif cmd=='QA' or cmd=='QI':
       if help: print('  QA             query actual current');return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg('I_OUT')/self.rdpsu.imultvar,end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('I_OUT',self.rdpsu.imultvar))
     elif cmd=='QBV' or cmd=='QVB':
       if help: print('  QBV            query battery voltage');return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg('V_BAT')/self.rdpsu.vmult,end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('V_BAT',self.rdpsu.vmult))
     elif cmd=='QMV':
       if help: print('  QMV            query actual voltage, integer millivolts');return False
-      if not dryrun: self.rdpsu.sync();print(int(1000*self.rdpsu.getreg('V_OUT')/self.rdpsu.vmult),end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('V_OUT',self.rdpsu.vmult,milli=True))
     elif cmd=='QMA':
       if help: print('  QMA            query actual current, integer milliamps');return False
-      if not dryrun: self.rdpsu.sync();print(int(1000*self.rdpsu.getreg('I_OUT')/self.rdpsu.imultvar),end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('I_OUT',self.rdpsu.imultvar,milli=True))
     elif cmd=='QBMV':
       if help: print('  QBMV           query battery voltage, integer millivolts');return False
-      if not dryrun: self.rdpsu.sync();print(int(1000*self.rdpsu.getreg('V_BAT')/self.rdpsu.vmult),end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('V_BAT',self.rdpsu.vmult,milli=True))
     elif cmd=='QTE':
       if help: print('  QTE            query external temperature');return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg('EXT_C'),end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('EXT_C'))
     elif cmd=='QTI':
       if help: print('  QTI            query internal temperature');return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg('INT_C'),end=self.qend)
+      self.needs(state=True)
+      self.act(dryrun,lambda: self.printreg('INT_C'))
 
     # direct register-level access
     elif cmd[:4]=='QREG' or cmd[:1]=='Q':
@@ -1105,65 +2404,75 @@ class PowerSupply:
       name=cmd[4:] if cmd[:4]=='QREG' else cmd[1:]
       try: reg=self.rdpsu.name2reg(name)
       except: print('[Unknown register to query:',cmd,'seen as "'+name+'" ]',file=stderr);return False
-      if not dryrun: self.rdpsu.sync();print(self.rdpsu.getreg(reg),end=self.qend)
+      self.needs(state=True,cached=[reg])
+      self.act(dryrun,lambda: self.printreg(reg))
     # individual register writes, lowlevel, CAUTION
     elif cmd[:3]=='REG' and '=' in cmd:
       if help: print('  REGxx=yy       write register xx to value yy (decimal)');return False
       a=cmd[3:].split('=')
       try: reg=self.rdpsu.name2reg(a[0]);val=int(a[1])
       except: print('[unknown register=value to set:',cmd,'seen as '+a[0]+'='+a[1]+' ]',file=stderr);return False
-      if not dryrun:
-        print('REGISTER WRITE:',reg,'=',val)
-        self.rdpsu.writereg(reg,val,cache=False) # no caching, immediate write
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.writereg(reg,val))
 
     # output switch control
     elif cmd=='ON':
       if help: print('  ON             enable output');return False
-      if not dryrun: self.rdpsu.setON()
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setON())
     elif cmd=='OFF':
       if help: print('  OFF            disable output');return False
-      if not dryrun: self.rdpsu.setOFF()
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setOFF())
     elif cmd=='TOGGLE':
       if help: print('  TOGGLE         toggle output');return False
-      if not dryrun: self.rdpsu.setTOGGLE()
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setTOGGLE())
 
     # volt/amp settings
     elif cmd[-1:]=='V':
       if help: print('  nn.nnV         set output voltage');return False
       try: val,rel=self.floatrel(cmd[:-1])
       except: print('[Unknown voltage to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setvolt(val,rel=rel)
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setvolt(val,rel=rel))
     elif cmd[-2:]=='MA':
       if help: print('  nn.nnMA        set output current');return False
       try: val,rel=self.floatrel(cmd[:-2])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setamp(val/1000,rel=rel)
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setamp(val/1000,rel=rel))
     elif cmd[-1:]=='A':
       if help: print('  nn.nnA         set output current');return False
       try: val,rel=self.floatrel(cmd[:-1])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setamp(val,rel=rel)
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.rdpsu.setamp(val,rel=rel))
 
     # OVP/OCP settings
     elif cmd[-2:]=='VO':
       if help: print('  nn.nnVO        set overvoltage protection');return False
       try: val,rel=self.floatrel(cmd[:-2])
       except: print('[Unknown voltage to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setovp(val,rel=rel)
+      self.needs(barrier=True,cached=[self.rdpsu.ovpreg] if rel else [])
+      self.act(dryrun,lambda: self.rdpsu.setovp(val,rel=rel))
     elif cmd[-3:]=='MAO':
       if help: print('  nn.nnMAO       set overcurrent protection');return False
       try: val,rel=self.floatrel(cmd[:-3])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setocp(val/1000,rel=rel)
+      self.needs(barrier=True,cached=[self.rdpsu.ocpreg] if rel else [])
+      self.act(dryrun,lambda: self.rdpsu.setocp(val/1000,rel=rel))
     elif cmd[-2:]=='AO':
       if help: print('  nn.nnAO        set overcurrent protection');return False
       try: val,rel=self.floatrel(cmd[:-2])
       except: print('[Unknown current to set:',cmd,']',file=stderr);return False
-      if not dryrun: self.rdpsu.setocp(val,rel=rel)
+      self.needs(barrier=True,cached=[self.rdpsu.ocpreg] if rel else [])
+      self.act(dryrun,lambda: self.rdpsu.setocp(val,rel=rel))
 
     # clock setting
     elif cmd=='SETCLOCK':
       if help: print('  SETCLOCK       set clock to current datetime');return False
+      self.needs(barrier=True)
       if not dryrun: self.rdpsu.setdatetime()
 
     # output formatting
@@ -1183,6 +2492,12 @@ class PowerSupply:
     elif cmd in ['ROBUST']:
       if help: print('  ROBUST         increase timeouts and retries');return False
       self.rdpsu.robust=True
+    elif cmd in ['NOPROFILE']:
+      if help: print('  NOPROFILE      identify device by reading, do not use or update the profile cache');return False
+      self.useprofiles=False
+    elif cmd in ['FAST']:
+      if help: print('  FAST           low-latency port mode, no waiting for stale data before transactions');return False
+      self.rdpsu.lowlatency=True
     # verbosity
     elif cmd in ['VERB','-V']:
       if help: print('  VERB or -V     list MODBUS transactions; affects subsequent commands');return False
@@ -1190,6 +2505,8 @@ class PowerSupply:
         self.rdpsu.modbus.setverbm(True)
         self.rdpsu.modbus.comm.verbconn=True
         self.rdpsu.verbauto=True
+    elif cmd in ['TIMING','--TIMING']:
+      if help: print('  TIMING         print startup phase times to stderr at exit');return False
     elif cmd in ['VERBCOMM','VERBPORT']:
       if help: print('  VERBCOMM       list comm port transactions');return False
       self.rdpsu.verbconn=True
@@ -1207,7 +2524,8 @@ class PowerSupply:
         try: secs=float(s)
         except: print('['+cmd+': Unknown delay to set:',s,']');return False
       else: secs=1
-      if not dryrun: self.rdpsu.sync();sleep(secs);self.rdpsu.forceread=True#self.rdpsu.written=True
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.pause(secs))
 
     # perform loop, help and validation only here
     elif cmd=='LOOP':
@@ -1217,6 +2535,18 @@ class PowerSupply:
         try: int(no)
         except: print('[Unknown loops count:',cmd,' seen as "'+no+'" ]');return False
 
+    # end of loop body, nesting checked when compiling
+    elif cmd=='END':
+      if help: print('  END            end the body of the innermost LOOP: or EVERY:, else it runs to the last command');return False
+
+    # period-locked loop, help and validation only here
+    elif cmd=='EVERY':
+      if help: print('  EVERY:s[:n[:policy]]  loop every s seconds, n times or endless; on overrun SKIP (default) or CATCHUP');return False
+      try: period=float(cmdarr[1]);int(cmdarr[2]) if cmdarr[2]!='' else 0
+      except: print('[Unknown period or count:',cmdorig,']',file=stderr);return False
+      if period<=0: print('[Period must be positive:',cmdorig,']',file=stderr);return False
+      if cmdarr[3].upper() not in ['','SKIP','CATCHUP']: print('[Unknown overrun policy:',cmdarr[3],']',file=stderr);return False
+
     # show device type
     elif cmd=='TYPE':
       if help: print('  TYPE           print detected device type');return False
@@ -1225,12 +2555,14 @@ class PowerSupply:
     # list status registers
     elif cmd=='REGS':
       if help: print('  REGS           dump registers');return False
-      if not dryrun: self.rdpsu.getprintregs()
+      self.needs(state=True,regs=range(0,42))
+      if not dryrun: self.printregs()
 
     # list presets
     elif cmd=='MEMS':
       if help: print('  MEMS           dump memories');return False
-      if not dryrun: self.rdpsu.printmems()
+      self.needs(regs=range(80,120))
+      if not dryrun: self.printmems()
 
     elif cmd[:6]=='SETMEM' and '=' in cmd:
       if help: print('  SETMEMx=v,a,vo,ao   set memory x to values');return False
@@ -1239,6 +2571,7 @@ class PowerSupply:
       try: addr=int(cmd[6:7]);xv=float(a[0]);xa=float(a[1]);xvo=float(a[2]);xao=float(a[3])
       except: print('[Cannot understad values:',cmd,']',file=stderr);return False
       if addr<0 or addr>9: print('[Address',addr,'must be >=0 and <=9.]');return False
+      self.needs(barrier=True)
       if not dryrun: self.rdpsu.setmem(addr,[xv,xa,xvo,xao])
 
     # select preset
@@ -1259,14 +2592,16 @@ class PowerSupply:
       if help: print('  REGSALL:n      dump n registers');return False
       num=120
       if cmdarr[1]=='':
-        if not dryrun: self.rdpsu.getprintregs(num=num)
+        self.needs(state=True,regs=range(0,num))
+        if not dryrun: self.printregs(num=num)
       else:
         try: num=int(cmdarr[1])
         except: print('[Unknown register count to read:',cmd,']',file=stderr);return False
+        self.needs(state=True,regs=range(0,num))
         if not dryrun:
           start=0
           while num>0:
-            if num>0: self.rdpsu.getprintregs(start=start,num=min(num,64),force=True);num-=64
+            if num>0: self.printregs(start=start,num=min(num,64),force=True);num-=64
             start+=64
 #        self.rdpsu.getprintregs(start=1*122,num=122)
 #        self.rdpsu.getprintregs(start=2*122,num=122)
@@ -1291,17 +2626,124 @@ class PowerSupply:
 
     elif cmd in ['REGSDIFF','REGDIFF','DIFFREG']:
       if help: print('  REGSDIFF       show registers difference');return False
-      if not dryrun: self.rdpsu.sync();self.rdpsu.compareregs()
+      self.needs(state=True)
+      if not dryrun: self.printregsdiff()
 
     elif cmd in ['STATE','STAT','STATUS']:
       if help: print('  STATE[:opts]   print setting state in JSON format')
-      if not dryrun: self.rdpsu.sync();self.rdpsu.printstate(opts=cmdarr[1])
+      self.needs(state=True,forcestate=True,ovpocp='S' not in cmdarr[1].upper())
+      self.act(dryrun,lambda: self.printstate(cmdarr[1]))
 
     elif cmd in ['JSTATE','JSTAT','JSTATUS','STATEJ','STATJ','STATUSJ']:
       if help: print('  STATEJ[:opts]  print setting state in JSON format, like opts=J')
-      if help: self.rdpsu.printstate(help=True);return False
-      if not dryrun: self.rdpsu.sync();self.rdpsu.printstate(opts='J'+cmdarr[1])
-
+      if help: print('          opts:  J=JSON, S=short (V/A only), T=show time, U=show UTC time, B=force battery');return False
+      self.needs(state=True,forcestate=True,ovpocp='S' not in cmdarr[1].upper())
+      self.act(dryrun,lambda: self.printstate('J'+cmdarr[1]))
+
+    # link statistics
+    elif cmd=='STATS':
+      if help: print('  STATS[:opts[:s]] print MODBUS transaction statistics; with s, to stderr every s seconds')
+      if help: print('          opts:  J=JSON, R=reset counters after printing');return False
+      opts=cmdarr[1].upper()
+      try: period=float(cmdarr[2]) if cmdarr[2]!='' else 0
+      except: print('[Unknown statistics period:',cmdorig,']',file=stderr);return False
+      if period>0:
+        self.statsperiod=period;self.statsopts=opts
+        self.statsnext=monotonic()+period
+      elif not dryrun: self.printstats(opts)
+
+    elif cmd=='RTT':
+      if help: print('  RTT[:J]        print round-trip estimator: smoothed turnaround, deviation, timeouts, circuit breaker');return False
+      if not dryrun: self.rdpsu.modbus.printrtt(json=cmdarr[1].upper()=='J')
+
+
+    # fast capture
+    elif cmd=='STREAM':
+      if help: print('  STREAM[:s[:regs[:fmt[:n]]]]  sample registers (V_OUT,I_OUT) every s seconds, n times; fmt C=CSV, B=binary');return False
+      try:
+        period=float(cmdarr[1]) if cmdarr[1]!='' else 0
+        regs=[self.rdpsu.name2reg(x) for x in (cmdarr[2] if cmdarr[2]!='' else 'V_OUT,I_OUT').upper().split(',')]
+        fmt=cmdarr[3].upper() if cmdarr[3]!='' else 'C'
+        count=int(cmdarr[4]) if cmdarr[4]!='' else -1
+      except: print('[Unknown stream period, registers or count:',cmdorig,']',file=stderr);return False
+      if fmt not in ['C','B']: print('[Unknown stream format:',fmt,']',file=stderr);return False
+      if max(regs)-min(regs)>=125: print('[Stream registers span more than 125:',cmdorig,']',file=stderr);return False
+      if not dryrun: self.runstream(period,regs,fmt,count)
+
+    # setpoint profile
+    elif cmd=='SEQUENCE':
+      if help: print('  SEQUENCE:file[:n[:policy]]  set time,V,I[,OVP,OCP] points from file on schedule, read output every n-th; late SKIP (default) or CATCHUP');return False
+      try: points=self.readsequence(cmdarr[1]);dec=int(cmdarr[2]) if cmdarr[2]!='' else 0
+      except (OSError,ValueError) as e: print('[Cannot load sequence:',cmdorig,e,']',file=stderr);return False
+      policy=cmdarr[3].upper() or 'SKIP'
+      if policy not in ['SKIP','CATCHUP']: print('[Unknown late point policy:',cmdarr[3],']',file=stderr);return False
+      self.needs(barrier=True)
+      self.act(dryrun,lambda: self.runsequence(points,dec,policy))
+
+    # binary register log
+    elif cmd=='BLOG':
+      if help: print('  BLOG:file      append state registers to binary log file');return False
+      if cmdorig[5:]=='': print('[Missing log file name:',cmdorig,']',file=stderr);return False
+      if not dryrun:
+        self.rdpsu.sync(force=True)
+        fn=cmdorig[5:]
+        try:
+          if fn not in self.blogs: self.blogs[fn]=RDRegLog(fn,self.rdpsu)
+          self.blogs[fn].append(self.rdpsu)
+        except (OSError,ValueError) as e: print('ERRLOG:',e,file=stderr);exit(1)
+    elif cmd=='LOGDUMP':
+      if help: print('  LOGDUMP:file   print binary log file as CSV, scaled');return False
+      if cmdorig[8:]=='': print('[Missing log file name:',cmdorig,']',file=stderr);return False
+      self.noport=True
+      if not dryrun:
+        try: self.logdump(cmdorig[8:])
+        except (OSError,ValueError) as e: print('ERRLOG:',e,file=stderr);exit(1)
+
+    # persistent session
+    elif cmd=='DAEMON':
+      if help: print('  DAEMON[:path]  keep connection open, serve commands from clients on unix socket');return False
+      if not dryrun: self.rundaemon(cmdorig[7:])
+    elif cmd=='CLIENT':
+      if help: print('  CLIENT[:path]  send the rest of the commands to a running DAEMON (must be first)');return False
+      if not dryrun: print('[CLIENT must be the first command]',file=stderr)
+
+    # many devices
+    elif cmd=='FLEET':
+      if help: print('  FLEET[:s[:n]]  poll all devices from fleet file, every s seconds, n times; JSON lines');return False
+      try: period=float(cmdarr[1]) if cmdarr[1]!='' else 0;count=int(cmdarr[2]) if cmdarr[2]!='' else (-1 if period>0 else 1)
+      except: print('[Unknown fleet period or count:',cmdorig,']',file=stderr);return False
+      self.noport=True
+      if not dryrun: self.runfleet(period,count)
+
+    # gateways
+    elif cmd=='SCPI':
+      if help: print('  SCPI[:port[:s]] SCPI server on TCP port (5025), measurements cached up to s seconds (0.5)');return False
+      try: port=int(cmdarr[1]) if cmdarr[1]!='' else 5025;maxage=float(cmdarr[2]) if cmdarr[2]!='' else 0.5
+      except: print('[Unknown SCPI port or cache age:',cmdorig,']',file=stderr);return False
+      if not dryrun: self.runscpi(port,maxage)
+
+    elif cmd=='PROM':
+      if help: print('  PROM[:port[:s]] Prometheus metrics on HTTP port (9160), device polled every s seconds (1)');return False
+      try: port=int(cmdarr[1]) if cmdarr[1]!='' else 9160;period=float(cmdarr[2]) if cmdarr[2]!='' else 1
+      except: print('[Unknown exporter port or poll period:',cmdorig,']',file=stderr);return False
+      if period<=0: print('[Poll period must be positive:',cmdorig,']',file=stderr);return False
+      if not dryrun: self.runprom(port,period)
+
+    elif cmd=='MBTCP':
+      if help: print('  MBTCP[:port[:s]] MODBUS/TCP server on port (502), reads within s seconds (0.01) merged');return False
+      try: port=int(cmdarr[1]) if cmdarr[1]!='' else 502;window=float(cmdarr[2]) if cmdarr[2]!='' else 0.01
+      except: print('[Unknown MODBUS/TCP port or merge window:',cmdorig,']',file=stderr);return False
+      if not dryrun: ModbusTCPGateway(self.rdpsu,window).serve(port)
+
+    # simulated device
+    elif cmd=='SIM':
+      if help: print('  SIM[:port[:type[:opts]]]  simulate device on TCP port (8888) or "pty", opts: see docs');return False
+      try: sim=RD60Simulator(cmdarr[2].upper() if cmdarr[2]!='' else 'RD6024');sim.setopts(cmdarr[3])
+      except Exception as e: print('[Cannot set up simulator:',cmdorig,e,']',file=stderr);return False
+      self.noport=True
+      if not dryrun:
+        if cmdarr[1].lower()=='pty': sim.servepty()
+        else: sim.servetcp(int(cmdarr[1]) if cmdarr[1]!='' else DEFAULT_TCPPORT)
 
     elif cmd[:4]=='TCP=':
       if help: print('  TCP=addr[:port]           set connection via TCP');return False
@@ -1331,10 +2773,11 @@ class PowerSupply:
     helparr=['ON','OFF',
              '-','xV','xMA','xA','xVO','xMAO','xAO',
              '-','QV','QA','QBV','QTE','QTI','QREG',
-             '-','STAT','JSTAT',
-             '-','REGx=y','REGS','REGSALL','REGSDIFF',
-             '-','TCP=','PORT=','ROBUST',
-             '-','BAT','NOBAT','STDIN','LOOP:','SLEEP','VERB','LINE','SETMEMx=','MEMS','SETCLOCK','CFGFILE']
+             '-','STAT','JSTAT','STATS','RTT','STREAM','BLOG','LOGDUMP',
+             '-','REGx=y','REGS','REGSALL','REGSDIFF','SEQUENCE',
+             '-','TCP=','PORT=','ROBUST','FAST','NOPROFILE',
+             '-','DAEMON','CLIENT','FLEET','SCPI','MBTCP','PROM','SIM',
+             '-','BAT','NOBAT','STDIN','LOOP:','EVERY:','END','SLEEP','VERB','TIMING','LINE','SETMEMx=','MEMS','SETCLOCK','CFGFILE']
     print('RD60 Riden RD60xx power supply control')
     print('Usage:',argv[0],'<command> [command]...')
     print('Commands:')
@@ -1347,46 +2790,135 @@ class PowerSupply:
     print('Command "-" forces a newline into output.')
 
 
-  # dryrun of commands list
+  # dryrun of commands list, compiled to the plan run by handlecommands
   def verifycommands(self,cmds):
     ok=True
+    plan=[];bodies=[plan]
     for x in cmds:
-      if not self.handlecommand(x,True): ok=False
+      self.curop=None
+      if not self.handlecommand(x,True): ok=False;continue
+      cmd=x.upper()
+      a=(cmd+':::').split(':')
+      step={'cmd':x,'name':a[0],'needs':self.curneeds,'op':self.curop}
+      if a[0]=='END':
+        if len(bodies)<2: print('[END without LOOP: or EVERY:]',file=stderr);ok=False;continue
+        bodies.pop();continue
+      if a[0]=='LOOP':
+        step['count']=int(a[1]) if a[1]!='' else -1;step['period']=None;step['body']=[]
+      elif a[0]=='EVERY':
+        step['count']=int(a[2]) if a[2]!='' else -1;step['period']=float(a[1]);step['policy']=a[3] or 'SKIP';step['body']=[]
+      elif a[0]!='STDIN' and step['op']==None: step['op']=self.reparse(x) # not compiled, parse again when run
+      bodies[-1].append(step)
+      if 'body' in step: bodies.append(step['body'])
+    self.curop=None;self.curneeds=None
+    self.plan=(list(cmds),plan)
     return ok
 
-  # dryrun of commands to check validity, then run live
+  def reparse(self,cmd):
+    return lambda: self.handlecommand(cmd,False,verb=False) # original case, for file names
+
+  ##### register reads planned by the dry run, read ahead once per pass (script, loop iteration)
+
+  curneeds=None # of the command in dry run
+  curop=None # compiled action of the command in dry run
+  plan=([],[]) # commands, and their steps: {cmd,name,needs,op}, loops with {count,period,policy,body}
+
+  def newneeds(self):
+    return {'state':False,'forcestate':False,'ovpocp':False,'regs':set(),'cached':set(),'barrier':False}
+
+  # note reads of the command in dry run: state block (by sync), OVP/OCP, explicit reads, single registers through the cache;
+  # barrier for writes and waits, after which read-ahead values are stale
+  def needs(self,state=False,forcestate=False,ovpocp=False,regs=(),cached=(),barrier=False):
+    n=self.curneeds
+    if n==None: return
+    n['state']=n['state'] or state
+    n['forcestate']=n['forcestate'] or forcestate
+    n['ovpocp']=n['ovpocp'] or ovpocp
+    n['regs'].update(regs)
+    n['cached'].update(cached)
+    n['barrier']=n['barrier'] or barrier
+
+  def hasreads(self,n):
+    return n['state'] or n['ovpocp'] or len(n['regs'])>0 or len(n['cached'])>0
+
+  # read ahead needs of the steps up to the next loop or barrier; False if nothing to read
+  def prefetch(self,steps):
+    a=self.newneeds()
+    for x in steps:
+      if x['op']==None: break # loop or stdin
+      n=x['needs']
+      for k in ['state','forcestate','ovpocp']: a[k]=a[k] or n[k]
+      for k in ['regs','cached']: a[k].update(n[k])
+      if n['barrier']: break
+    if not self.hasreads(a): return False
+    self.rdpsu.prefetch(a['regs'],a['cached'],a['state'],a['ovpocp'],a['forcestate'])
+    return True
+
+  # run the commands compiled by verifycommands; loops on a stack of passes, nothing parsed again
   def handlecommands(self,cmds):
-    #print("COMMANDS:",cmds)
-#    for x in cmds: self.handlecommand(x,False)
-    for t in range(0,len(cmds)):
-      cmd=cmds[t].upper()
-      #print('CMD:',cmd)
-      counter=-1 # endless
-      # recursive running of loop
-      if cmd[:5]=='LOOP:':
-        self.rdpsu.sync()
-        if len(cmd)>5: counter=int(cmd[5:]) # error check already done in dryrun parse
-        while counter!=0:
-          counter-=1
-          self.handlecommands(cmds[t+1:])
-          #if counter==0: break
-        break
-      # from now, everything comes from stdin
-      elif cmd=='STDIN':
-        #print('STDIN')
-        while True:
+    if self.plan[0]!=list(cmds): self.verifycommands(cmds)
+    stack=[{'body':self.plan[1],'t':0,'count':1,'tick':None,'prefetched':False}]
+    try:
+      while stack!=[]:
+        f=stack[-1]
+        if f['t']>=len(f['body']): # end of pass
+          self.rdpsu.writecache()
+          self.rdpsu.prefetched={}
+          f['count']-=1
+          if f['count']!=0: self.startpass(f);continue
+          stack.pop()
+          if f['tick']!=None: print(f['tick'].report('EVERY'),file=stdlog)
+          continue
+        step=f['body'][f['t']];f['t']+=1
+        # loop on the rest of the body, or up to END
+        if step['name'] in ['LOOP','EVERY']:
           self.rdpsu.sync()
-          s=stdin.readline().strip()
-          if s=='': break # pipe closed
-          if self.handlecommand(s,True): self.handlecommand(s,False) # check validity, execute if good
-      else:
-        if self.qend==' ' and cmd[:5]=='SLEEP': print()
-        self.handlecommand(cmd,False,verb=False)
-    self.rdpsu.writecache()
-
-
-
-
+          if step['count']==0: continue
+          g={'body':step['body'],'t':0,'count':step['count'],'tick':None,'prefetched':False}
+          if step['period']!=None: g['tick']=Ticker(step['period'],step['policy']) # loop on fixed deadlines, statistics at exit
+          stack.append(g);self.startpass(g)
+        # from now, everything comes from stdin
+        elif step['name']=='STDIN':
+          while True:
+            self.rdpsu.sync()
+            s=stdin.readline().strip()
+            if s=='': break # pipe closed
+            if self.handlecommand(s,True): self.handlecommand(s,False) # check validity, execute if good
+            self.checkstats()
+        else:
+          if self.qend==' ' and step['name'][:5]=='SLEEP': print()
+          n=step['needs']
+          if not f['prefetched'] and self.hasreads(n): f['prefetched']=self.prefetch(f['body'][f['t']-1:])
+          self.lastcmd=step['name']
+          step['op']()
+          if n['barrier']: f['prefetched']=False
+          self.checkstats()
+    finally: # interrupted
+      for f in reversed(stack):
+        if f['tick']!=None: print(f['tick'].report('EVERY'),file=stdlog)
+    self.rdpsu.prefetched={}
+
+  def startpass(self,f):
+    f['t']=0;f['prefetched']=False
+    if f['tick']!=None: f['tick'].wait()
+
+
+
+
+  statsperiod=0 # periodic statistics dump
+  statsnext=0
+  statsopts=''
+
+  def printstats(self,opts,file=None):
+    self.rdpsu.modbus.printstats(json='J' in opts,file=file)
+    if 'R' in opts: self.rdpsu.modbus.stats.reset()
+
+  # periodic statistics dump, between commands, for long loops
+  def checkstats(self):
+    if self.statsperiod<=0 or monotonic()<self.statsnext: return
+    self.statsnext=max(self.statsnext+self.statsperiod,monotonic())
+    self.printstats(self.statsopts,file=stdlog)
+    stdlog.flush()
 
 
 
@@ -1420,6 +2952,15 @@ class PowerSupply:
 # port=8888
 
 # physical port takes precedence if both are defined
+
+# low-latency mode, same as FAST command
+# lowlatency=1
+
+# list of devices for FLEET, default is ~/.<name>.fleet
+# fleet=~/rd60.fleet
+
+# cache of device identification, default is ~/.<name>.profiles
+# profiles=~/rd60.profiles
 """)
     exit(0)
 
@@ -1455,25 +2996,917 @@ class PowerSupply:
   # initialize port from configuration in self.conf
   def initport(self):
     #global comm,port,self.rdpsu
-    if 'serport' in self.conf:
-      port=self.conf['serport']
-      baud=DEFAULT_BAUDRATE if 'baudrate' not in self.conf else self.cfgint(self.conf['baudrate'],default=DEFAULT_BAUDRATE)
-      self.comm=LowLevelSerPort(port,baud)
-    elif 'host' in self.conf:
-      host=self.conf['host']
-      port=DEFAULT_TCPPORT if 'port' not in self.conf else self.cfgint(self.conf['port'],default=DEFAULT_TCPPORT)
-      self.comm=LowLevelTcpPort(host,port)
-    else:
+    self.comm=self.makeport(self.conf)
+    if self.comm==None:
+      if self.noport: self.rdpsu=PSU_RD60XX();return # fleet file devices, simulator
       print('ERROR: unknown serial port or TCP host',file=stderr)
       print('Use TCP=<host>[:port] or PORT=[/dev/tty...]',file=stderr)
       exit(1)
 
     self.rdpsu=PSU_RD60XX()
     self.rdpsu.modbus.initport(self.comm)
+    if self.cfgint(self.conf.get('lowlatency','0'),default=0)>0: self.rdpsu.lowlatency=True
+    if self.useprofiles: self.rdpsu.profile=self.readprofiles().get(self.getprofilekey())
+
+  # create port object from configuration dict, None if not configured
+  def makeport(self,conf):
+    if 'serport' in conf:
+      port=conf['serport']
+      baud=DEFAULT_BAUDRATE if 'baudrate' not in conf else self.cfgint(conf['baudrate'],default=DEFAULT_BAUDRATE)
+      return LowLevelSerPort(port,baud)
+    elif 'host' in conf:
+      host=conf['host']
+      port=DEFAULT_TCPPORT if 'port' not in conf else self.cfgint(conf['port'],default=DEFAULT_TCPPORT)
+      return LowLevelTcpPort(host,port)
+    return None
 
-  # close port
+  # close port and logs, update profile cache
   def close(self):
+    for x in self.blogs.values(): x.close()
     self.rdpsu.close()
+    if self.useprofiles and self.comm!=None: self.saveprofile()
+
+
+  ##### device profiles: type, multipliers, ID/serial/firmware of devices seen, to skip identification next time
+
+  useprofiles=True
+  comm=None
+
+  # profiles file name, from configfile (profiles=...) or process name
+  def getprofilesname(self):
+    from os.path import expanduser
+    return expanduser(self.conf.get('profiles','~/.'+self.getprocessbarename()+'.profiles'))
+
+  # device key: host:port or serial port, and MODBUS address
+  def getprofilekey(self):
+    if isinstance(self.comm,LowLevelTcpPort): return f'{self.comm.ipaddr}:{self.comm.ipport}/{self.rdpsu.modbus.addr}'
+    return f'{self.comm.serport}/{self.rdpsu.modbus.addr}'
+
+  # read profiles file; one device per line: key name=value...  ; missing file is empty
+  def readprofiles(self):
+    res={}
+    try:
+      with open(self.getprofilesname(),'r') as f:
+        for s in f.read().split('\n'):
+          s=s.split('#')[0].split()
+          if len(s)<2: continue
+          res[s[0]]=dict(x.split('=',1) for x in s[1:] if '=' in x)
+    except OSError: pass
+    return res
+
+  # store identification of current device, if new or changed
+  def saveprofile(self):
+    import os
+    p=self.rdpsu.getprofile()
+    if p==None or p==self.rdpsu.profile: return
+    profiles=self.readprofiles()
+    profiles[self.getprofilekey()]=p
+    fn=self.getprofilesname()
+    tmp=f'{fn}.{os.getpid()}.tmp' # written aside and renamed over, concurrent runs never see a partial file
+    try:
+      with open(tmp,'w') as f:
+        f.write('# device profiles, written automatically; delete a line or the file to identify the device again\n')
+        for x in sorted(profiles): f.write(x+' '+' '.join(f'{k}={v}' for k,v in profiles[x].items())+'\n')
+      os.replace(tmp,fn)
+    except OSError as e:
+      print('WARN: cannot write profiles file:',e,file=stdlog)
+      try: os.unlink(tmp)
+      except OSError: pass
+
+
+  ##### stream: one minimal register window read per sample, no state decoding
+
+  # scaling divisors of volt/amp/watt registers, from the multipliers detected now
+  def getscales(self):
+    m=self.rdpsu.getmults()
+    return {x.addr:m[x.scale] for x in self.rdpsu.regmap.byaddr.values() if x.scale in m}
+
+  # sample registers every period seconds (0=back to back), count times (-1 endless), to stdout as CSV or binary records
+  # CSV: tsend,trecv and the listed registers, scaled to volts/amps/watts where applicable
+  # binary: little-endian double tsend, double trecv, then all registers of the window as unsigned 16-bit, unscaled
+  def runstream(self,period,regs,fmt,count):
+    from sys import stdout
+    psu=self.rdpsu
+    psu.sync()
+    start=min(regs);num=max(regs)-start+1
+    scale=self.getscales()
+    stdout.flush()
+    out=stdout.buffer # buffered, not flushed per sample
+    if fmt=='B':
+      rec=Struct('<dd'+'H'*num)
+      print(f'STREAM: binary records of {rec.size} bytes, format {rec.format}, registers {start}..{start+num-1}',file=stdlog)
+    else: out.write(('tsend,trecv,'+','.join(psu.regmap.name(x,str(x)) for x in regs)+'\n').encode())
+    tick=Ticker(period)
+    n=0
+    ts=tfirst=tick.start
+    try:
+      while n!=count:
+        tick.wait()
+        ts=monotonic()
+        if n==0: tfirst=ts
+        vals=psu.modbus.modbus_readregs(start,num)
+        tr=monotonic()
+        if fmt=='B': out.write(rec.pack(ts-tick.start,tr-tick.start,*vals))
+        else: out.write((f'{ts-tick.start:.6f},{tr-tick.start:.6f},'+','.join(str(vals[x-start]/scale[x]) if x in scale else str(vals[x-start]) for x in regs)+'\n').encode())
+        n+=1
+    finally:
+      out.flush()
+      rate=(n-1)/(ts-tfirst) if n>1 else 0
+      print(f'STREAM: {n} samples in {monotonic()-tick.start:.3f} s, {rate:.1f} samples/s, {tick.missed} missed deadlines, {tick.jitterstr()}',file=stdlog)
+
+  ##### setpoint sequencer
+
+  # profile from CSV or table: time,V,I[,OVP,OCP] per line, time in seconds from start; # comments, header line allowed
+  def readsequence(self,fn):
+    import re
+    points=[]
+    first=True
+    with open(fn) as f:
+      for no,line in enumerate(f,1):
+        a=[x for x in re.split(r'[,;\s]+',line.split('#')[0]) if x!='']
+        if a==[]: continue
+        try: p=[float(x) for x in a]
+        except ValueError:
+          if first: first=False;continue
+          raise ValueError(f'line {no}: not a number')
+        first=False
+        if len(p) not in [3,5]: raise ValueError(f'line {no}: need time,V,I or time,V,I,OVP,OCP')
+        if points!=[] and p[0]<points[-1][0]: raise ValueError(f'line {no}: time goes back')
+        points.append(p)
+    if points==[]: raise ValueError('no points')
+    return points
+
+  # play profile: raw values computed and checked first, each point one write of V_SET,I_SET pair on monotonic schedule,
+  # OVP/OCP when changed; output read back every dec-th point only
+  def runsequence(self,points,dec,policy):
+    psu=self.rdpsu
+    psu.sync()
+    vreg=psu.normreg('V_SET')
+    if psu.normreg('I_SET')!=vreg+1: raise RDError(f'SEQUENCE: V_SET,I_SET not adjacent on {psu.typename}')
+    lim=psu.RD_TYPES.get(psu.typename,{})
+    vmax=lim.get('Vmax',65535/psu.vmult);imax=lim.get('Imax',65535/psu.imultvar)
+    for p in points: # protection may be set a bit above the output range, not below the setpoint
+      if min(p[1:])<0 or p[1]>vmax or p[2]>imax or len(p)==5 and (p[3]>1.05*vmax or p[4]>1.05*imax or p[1]>p[3] or p[2]>p[4]):
+        raise RDError(f'SEQUENCE: point {p} out of range of {psu.typename}')
+    vi=[[int(round(p[1]*psu.vmult)),int(round(p[2]*psu.imultvar))] for p in points]
+    prot=[[int(round(p[3]*psu.vmult)),int(round(p[4]*psu.imult))] if len(p)==5 else None for p in points]
+    for p,a,b in zip(points,vi,prot):
+      if max(a+(b or []))>65535: raise RDError(f'SEQUENCE: point {p} out of register range')
+    if dec>0: print('time,Vset,Iset,Vout,Iout')
+    tick=Ticker(None,policy)
+    cur=[psu.getreg(vreg),psu.getreg(vreg+1)] # setpoints on the device
+    last=[None,None] # OVP,OCP written
+    n=0
+    try:
+      for k in range(0,len(points)):
+        if not tick.waitfor(points[k][0],points[k+1][0] if k+1<len(points) else None): continue
+        # each protection before the new setpoints if not below the current ones, else after, never tripping in between
+        before=[];after=[]
+        if prot[k]!=None:
+          for t in [0,1]:
+            if prot[k][t]!=last[t]: (before if prot[k][t]>=cur[t] else after).append(t)
+        self.writeprot(prot[k],before,last)
+        psu.writeregs(vreg,vi[k])
+        cur=vi[k]
+        self.writeprot(prot[k],after,last)
+        n+=1
+        if dec>0 and n%dec==0:
+          vout,iout=psu.readregs('V_OUT',2)
+          print(f'{monotonic()-tick.start:.3f},{points[k][1]:g},{points[k][2]:g},{vout/psu.vmult:g},{iout/psu.imultvar:g}')
+    finally:
+      if last[0]!=None: psu.ovp=last[0]/psu.vmult
+      if last[1]!=None: psu.ocp=last[1]/psu.imult
+      psu.forceread=True
+      print(f'SEQUENCE: {n} of {len(points)} points in {monotonic()-tick.start:.3f} s, {tick.missed} late past the next point ({"caught up" if tick.catchup else "skipped"}), {tick.jitterstr()}',file=stdlog)
+
+  # write OVP (0) and/or OCP (1) of pr, both in one transaction
+  def writeprot(self,pr,which,last):
+    psu=self.rdpsu
+    if which==[0,1]: psu.writeregs(psu.ovpreg,pr)
+    elif which!=[]: psu.writereg(psu.ovpreg+which[0],pr[which[0]],cache=False)
+    for t in which: last[t]=pr[t]
+
+  ##### binary register log
+
+  blogs={} # open logs by file name, kept open for loops
+
+  # print log as CSV: time, then registers of the window scaled where applicable, Ah/Wh
+  def logdump(self,fn):
+    from sys import stdout
+    with RDRegLogReader(fn) as log:
+      names=log.columns()
+      print(f'# {fn}: {log.typename}, {len(log)} records, registers {log.start}..{log.start+log.num-1}',file=stdlog)
+      cols=[log.column(x) for x in names]
+      print(','.join(names))
+      for i in range(0,len(log)): stdout.write(f'{cols[0][i]:.3f},'+','.join(f'{x[i]:g}' for x in cols[1:])+'\n')
+
+  ##### fleet: many devices polled in parallel, merged JSON lines output
+
+  noport=False # mode does not use the configured device port (fleet, simulator)
+  fleetworkers=16
+
+  # fleet file name, from configfile (fleet=...) or process name
+  def getfleetname(self):
+    from os.path import expanduser
+    return expanduser(self.conf.get('fleet','~/.'+self.getprocessbarename()+'.fleet'))
+
+  # read fleet file; one device per line: name host=... [port=...] [addr=...]  or  name serport=... [baudrate=...] [addr=...]
+  def readfleet(self):
+    fn=self.getfleetname()
+    devs={}
+    try:
+      with open(fn,'r') as f:
+        for s in f.read().split('\n'):
+          s=s.split('#')[0].split()
+          if len(s)<2: continue
+          devs[s[0]]=dict(x.split('=',1) for x in s[1:] if '=' in x)
+    except Exception as e:
+      print('ERRFLEET: cannot read fleet file',fn,'-',e,file=stderr)
+      exit(1)
+    return devs
+
+  # create device for fleet member, with modes set on the command line
+  def makefleetpsu(self,name,conf):
+    comm=self.makeport(conf)
+    if comm==None: raise ValueError(f'no host or serport for {name}')
+    psu=PSU_RD60XX(comm)
+    psu.modbus.addr=self.cfgint(conf.get('addr',str(DEFAULT_MODBUS_ADDR)),default=DEFAULT_MODBUS_ADDR)
+    for x in ['robust','lowlatency','verbconn','bat','bat_forcemode']: setattr(psu,x,getattr(self.rdpsu,x))
+    return psu
+
+  # one poll of one device, in worker thread; returns line dict, device object (None when dropped)
+  def pollfleetpsu(self,name,conf,psu):
+    try:
+      if psu==None: # first sample from the identifying read
+        psu=self.makefleetpsu(name,conf)
+        psu.initregs()
+      else: psu.sync(force=True)
+      a={'dev':name}
+      a.update(psu.getstate('JT'))
+      return a,psu
+    except KeyboardInterrupt: raise
+    except Exception as e: # the device only is dropped
+      from datetime import datetime
+      err=str(e)
+      if psu!=None:
+        try: psu.close()
+        except Exception: pass
+      return {'dev':name,'time':datetime.now().isoformat()[:23],'error':err},None
+
+  # poll all fleet devices every period seconds, count times (-1 endless)
+  # device still busy from previous round is skipped this round
+  def runfleet(self,period,count):
+    from concurrent.futures import ThreadPoolExecutor,as_completed,TimeoutError
+    from json import dumps
+    from sys import stdout
+    devs=self.readfleet()
+    psus=dict.fromkeys(devs)
+    busy={}
+    pool=ThreadPoolExecutor(max_workers=min(self.fleetworkers,max(1,len(devs))))
+    nexttime=monotonic()
+    try:
+      while count!=0:
+        count-=1
+        for name in devs:
+          if name not in busy.values(): busy[pool.submit(self.pollfleetpsu,name,devs[name],psus[name])]=name
+        nexttime+=period
+        try:
+          for fut in as_completed(list(busy),timeout=None if count==0 else max(0,nexttime-monotonic())):
+            a,psus[busy.pop(fut)]=fut.result()
+            print(dumps(a))
+            stdout.flush()
+        except TimeoutError: pass # stragglers are reported in later rounds
+        if count!=0: sleep(max(0,nexttime-monotonic()))
+    finally:
+      pool.shutdown(wait=True,cancel_futures=True) # running polls finish their transactions before the ports close
+      for x in psus.values():
+        if x!=None: x.close()
+
+  ##### SCPI gateway: many clients, one device, measurements from one shared poll
+
+  # long forms of SCPI keywords to short forms
+  SCPI_WORDS={'VOLTAGE':'VOLT','CURRENT':'CURR','OUTPUT':'OUTP','MEASURE':'MEAS','POWER':'POW','SOURCE':'SOUR','SYSTEM':'SYST','ERROR':'ERR','STATE':'STAT',
+              'LEVEL':'LEV','IMMEDIATE':'IMM','AMPLITUDE':'AMPL'}
+
+  # serve SCPI clients on TCP port; all share the device and its register cache, which is reread when older than maxage
+  def runscpi(self,port,maxage):
+    import socketserver,threading
+    lock=threading.Lock()
+    self.rdpsu.readcachetimeout=maxage
+    self.rdpsu.initregs()
+    ps=self
+    class SCPIHandler(socketserver.StreamRequestHandler):
+      def handle(self):
+        errs=[] # error queue of this client, for SYST:ERR?
+        for line in self.rfile:
+          res=[ps.scpicommand(c.strip(),lock,errs) for c in line.decode(errors='replace').strip().split(';')]
+          res=[x for x in res if x!=None]
+          if res!=[]: self.wfile.write((';'.join(res)+'\n').encode())
+    socketserver.ThreadingTCPServer.allow_reuse_address=True
+    srv=socketserver.ThreadingTCPServer(('',port),SCPIHandler)
+    srv.daemon_threads=True
+    print('SCPI: listening on port',port,file=stdlog)
+    try: srv.serve_forever()
+    finally: srv.server_close()
+
+  # execute single SCPI command; returns response string for queries, None otherwise
+  def scpicommand(self,c,lock,errs):
+    if c=='': return None
+    hdr,_,arg=c.partition(' ')
+    hdr=hdr.upper().lstrip(':')
+    query=hdr.endswith('?')
+    words=[self.SCPI_WORDS.get(x,x) for x in hdr.rstrip('?').split(':')]
+    if words[0]=='SOUR': words=words[1:]
+    while len(words)>1 and words[-1] in ['DC','STAT','AMPL','IMM','LEV']: words=words[:-1] # default nodes, VOLT:LEV:IMM:AMPL is VOLT
+    key=':'.join(words)+('?' if query else '')
+    arg=arg.strip().upper()
+    psu=self.rdpsu
+    try:
+      with lock:
+        if key=='*IDN?':
+          return f'RIDEN,{psu.typename},{psu.getreg32("SN_H")},{psu.getreg("FW")/100}'
+        elif key=='SYST:ERR?':
+          return errs.pop(0) if errs!=[] else '0,"No error"'
+        elif key in ['MEAS:VOLT?','MEAS:CURR?','MEAS:POW?','VOLT?','CURR?','OUTP?']:
+          psu.sync()
+          if key=='MEAS:VOLT?': return str(psu.getreg('V_OUT')/psu.vmult)
+          if key=='MEAS:CURR?': return str(psu.getreg('I_OUT')/psu.imultvar)
+          if key=='MEAS:POW?':  return str(psu.getreg('P_OUT')/psu.pmult)
+          if key=='VOLT?':      return str(psu.getreg('V_SET')/psu.vmult)
+          if key=='CURR?':      return str(psu.getreg('I_SET')/psu.imultvar)
+          if key=='OUTP?':      return str(psu.getreg('OUTPUT'))
+        elif key=='VOLT': psu.setvolt(float(arg.rstrip('V')));psu.sync()
+        elif key=='CURR': psu.setamp(float(arg.rstrip('A')));psu.sync()
+        elif key=='OUTP':
+          if arg in ['ON','1']: psu.setON()
+          elif arg in ['OFF','0']: psu.setOFF()
+          else: raise ValueError(arg)
+        elif key=='*CLS': errs.clear()
+        else: errs.append('-113,"Undefined header"')
+    except ValueError: errs.append('-224,"Illegal parameter value"')
+    except KeyboardInterrupt: raise
+    except Exception as e: # RDError of lower layers; reconnect on next command
+      print('SCPI:ERR:',c,e,file=stdlog)
+      errs.append('-240,"Hardware error"')
+      try: psu.close()
+      except Exception: pass
+    return None
+
+  ##### Prometheus exporter: background poll of one device, scrapes served from the last poll only
+
+  # state key, metric name, help, type
+  PROM_METRICS=[('Vout','rd60_output_volts','Measured output voltage','gauge'),
+                ('Iout','rd60_output_amps','Measured output current','gauge'),
+                ('Pout','rd60_output_watts','Measured output power','gauge'),
+                ('Vin','rd60_input_volts','Input voltage','gauge'),
+                ('Vset','rd60_set_volts','Voltage setpoint','gauge'),
+                ('Iset','rd60_set_amps','Current setpoint','gauge'),
+                ('OVP','rd60_ovp_volts','Overvoltage protection limit','gauge'),
+                ('OCP','rd60_ocp_amps','Overcurrent protection limit','gauge'),
+                ('out','rd60_output_enabled','Output switched on','gauge'),
+                ('cccv','rd60_cc_mode','Constant current mode (0=CV, 1=CC)','gauge'),
+                ('ovpocp','rd60_protection','Protection tripped (0=none, 1=OVP, 2=OCP)','gauge'),
+                ('tempint','rd60_internal_celsius','Internal temperature','gauge'),
+                ('tempext','rd60_external_celsius','External probe temperature','gauge'),
+                ('Vbat','rd60_battery_volts','Battery voltage','gauge'),
+                ('Ah','rd60_battery_amphours','Battery charge counter','gauge'),
+                ('Wh','rd60_battery_watthours','Battery energy counter','gauge')]
+
+  # serve metrics over HTTP on port; the device is polled every period seconds by one thread, whatever the number of scrapers
+  def runprom(self,port,period):
+    import threading
+    from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+    poll={'state':{},'info':'','up':0,'time':0,'polls':0,'errors':0}
+    lock=threading.Lock()
+    ps=self
+    def poller():
+      nexttime=monotonic()
+      while True:
+        a=ps.pollprom(poll['polls'])
+        with lock:
+          poll['polls']+=1
+          if a==None: poll['up']=0;poll['errors']+=1
+          else: poll['state']=a;poll['up']=1;poll['time']=monotonic()
+          poll['stats']=ps.rdpsu.modbus.stats.getstats()['ranges']
+        nexttime+=period
+        sleep(max(0,nexttime-monotonic()))
+    class PromHandler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ['/','/metrics']: self.send_error(404);return
+        with lock: res=ps.getpromtext(poll).encode()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(res)))
+        self.end_headers()
+        self.wfile.write(res)
+      def log_message(self,*args): pass
+    srv=ThreadingHTTPServer(('',port),PromHandler)
+    srv.daemon_threads=True
+    threading.Thread(target=poller,daemon=True).start()
+    print('PROM: listening on port',port,file=stdlog)
+    try: srv.serve_forever()
+    finally: srv.server_close()
+
+  # one poll of state, OVP/OCP refreshed every tenth poll; returns state dict or None on failure
+  def pollprom(self,n):
+    psu=self.rdpsu
+    try:
+      psu.sync(force=True)
+      if n%10==0 and n>0: psu.readovpocp() # first read by initregs
+      a=psu.getstate()
+      a['info']=f'model="{psu.typename}",serial="{psu.getreg32("SN_H")}",fw="{psu.getreg("FW")/100}"'
+      return a
+    except KeyboardInterrupt: raise
+    except Exception as e: # RDError of lower layers; reconnect on next poll
+      print('PROM:ERR:',e,file=stdlog)
+      try: psu.close()
+      except Exception: pass
+      return None
+
+  # exposition text from last poll
+  def getpromtext(self,poll):
+    a=poll['state']
+    res=[]
+    def metric(name,help,type,val,labels=''):
+      res.append(f'# HELP {name} {help}\n# TYPE {name} {type}\n{name}{"{"+labels+"}" if labels else ""} {val}')
+    metric('rd60_up','Last poll of the device succeeded','gauge',poll['up'])
+    if 'info' in a: metric('rd60_info','Device identification','gauge',1,a['info'])
+    for key,name,help,type in self.PROM_METRICS:
+      if key in a and poll['up']: metric(name,help,type,a[key])
+    if poll['time']>0: metric('rd60_poll_age_seconds','Time since last successful poll','gauge',round(monotonic()-poll['time'],3))
+    metric('rd60_polls_total','Device polls','counter',poll['polls'])
+    metric('rd60_poll_errors_total','Failed device polls','counter',poll['errors'])
+    st=poll.get('stats',[])
+    for x,name,help in [('req','rd60_modbus_requests_total','MODBUS transactions'),('retry','rd60_modbus_retries_total','MODBUS retried attempts'),
+                        ('fail','rd60_modbus_failures_total','MODBUS transactions failed after all retries')]:
+      metric(name,help,'counter',sum(r[x] for r in st))
+    return '\n'.join(res)+'\n'
+
+  ##### persistent session: daemon owns the connection and register cache, clients send command lines
+
+  indaemon=False
+  DAEMON_REFUSED=['STDIN','DAEMON','CLIENT','TCP=','PORT=','CFGFILE'] # would block, recurse or reconfigure the daemon
+
+  # unix socket name, from parameter, configfile (socket=...) or process name
+  def getsockname(self,path=''):
+    from os.path import expanduser
+    if path=='' and 'socket' in self.conf: path=self.conf['socket']
+    if path=='': path='~/.'+self.getprocessbarename()+'.sock'
+    return expanduser(path)
+
+  # listen on unix socket, execute each received command line against the shared connection
+  def rundaemon(self,path=''):
+    import os,socket
+    fn=self.getsockname(path)
+    srv=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    if os.path.exists(fn):
+      try: srv.connect(fn);print('ERRDAEMON: daemon already running on',fn,file=stderr);exit(12)
+      except OSError: os.unlink(fn) # stale socket from previous run
+      srv.close()
+      srv=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    srv.bind(fn)
+    srv.listen(5)
+    self.rdpsu.initregs() # connect and identify once, for the whole daemon lifetime
+    print('DAEMON: listening on',fn,file=stdlog)
+    self.indaemon=True
+    try:
+      while True:
+        conn,_=srv.accept()
+        try: self.daemonrequest(conn)
+        except Exception as e: print('DAEMON:ERR:',e,file=stdlog)
+        finally: conn.close()
+    finally:
+      self.indaemon=False
+      srv.close()
+      os.unlink(fn)
+
+  # handle one client: read command line, stream output back, terminate with \0 and return code
+  def daemonrequest(self,conn):
+    from contextlib import redirect_stdout
+    data=b''
+    while not data.endswith(b'\n'):
+      s=conn.recv(4096)
+      if s==b'': break
+      data+=s
+    cmds=data.decode(errors='replace').split()
+    if cmds==[]: cmds=['STATE']
+    if self.verbcmd: print('DAEMON:REQ:',cmds,file=stdlog)
+    out=conn.makefile('w',buffering=1)
+    rc=0
+    modes=self.savemodes()
+    with redirect_stdout(out):
+      self.qend='\n'
+      try:
+        bad=[x for x in cmds for y in self.DAEMON_REFUSED if x.upper().startswith(y)]
+        if bad!=[]: print('[Not available via daemon:',' '.join(bad),']');rc=1
+        elif not self.verifycommands(cmds): print('Command error.');rc=1
+        else: self.handlecommands(cmds)
+      except RDError as e: print(e,file=stdlog);rc=e.exitcode
+      except SystemExit as e: rc=e.code if isinstance(e.code,int) else 1
+      finally:
+        if self.lastcmd[:5]=='SLEEP' and self.qend==' ': print()
+        self.restoremodes(modes)
+    out.flush()
+    conn.sendall(b'\0'+str(rc).encode()+b'\n')
+
+  # modes a request can switch (LINE, STATS period, BAT, VERB, ...), to put back after it as for a fresh run
+  def savemodes(self):
+    psu=self.rdpsu
+    return ([(self,x,getattr(self,x)) for x in ['qend','statsperiod','statsopts','statsnext','useprofiles']]+
+            [(psu,x,getattr(psu,x)) for x in ['bat','bat_forcemode','robust','lowlatency','verbauto','verbconn']]+
+            [(psu.modbus,'verbm',psu.modbus.verbm)]+[(psu.modbus.comm,x,getattr(psu.modbus.comm,x)) for x in ['verbconn','lowlatency']])
+
+  def restoremodes(self,modes):
+    psu=self.rdpsu
+    forced=psu.bat_forcemode
+    for obj,x,val in modes:
+      if obj is psu and x=='bat' and not forced: continue # detected battery mode stays
+      setattr(obj,x,val)
+
+  # send commands to daemon, copy its output to stdout, exit with its return code
+  def runclient(self,path,cmds):
+    import socket
+    from sys import stdout
+    fn=self.getsockname(path)
+    s=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try: s.connect(fn)
+    except OSError as e:
+      print('ERRDAEMON: cannot connect to daemon at',fn,'-',e,file=stderr)
+      exit(12)
+    s.sendall((' '.join(cmds)+'\n').encode())
+    out=stdout.buffer
+    tail=None
+    while True:
+      r=s.recv(65536)
+      if r==b'': break
+      if tail!=None: tail+=r;continue
+      if b'\0' in r: r,_,tail=r.partition(b'\0')
+      out.write(r)
+      out.flush()
+    s.close()
+    try: rc=int(tail.strip())
+    except (ValueError,AttributeError): print('ERRDAEMON: connection closed without return code',file=stderr);rc=15
+    exit(rc)
+
+
+
+##########################
+##
+##  MODBUS/TCP GATEWAY
+##
+##########################
+
+
+# MODBUS/TCP (MBAP) server in front of the single RTU link; functions 3, 6, 16
+# reads arriving within the merge window are served by one upstream read of their union
+class ModbusTCPGateway:
+  MAXREGS=125   # MODBUS limit for single read
+  verb=False
+
+  def __init__(self,rdpsu,window=0.01):
+    import threading
+    self.rdpsu=rdpsu
+    self.modbus=rdpsu.modbus
+    self.window=window
+    self.buslock=threading.Lock()     # one transaction on the link at a time
+    self.cond=threading.Condition()   # guards batch
+    self.batch=None                   # reads collected for the next upstream read
+    self.upreads=0                    # upstream read transactions
+    self.clreads=0                    # client read requests
+    self.clients=0                    # connected clients
+    self.verb=self.modbus.verbm
+
+  # read registers, merged with other clients' reads in the same window, no waiting with a single client;
+  # returns list of values or exception code
+  def read(self,start,num):
+    with self.cond:
+      self.clreads+=1
+      leader=self.batch==None
+      if leader: self.batch={'reqs':[],'done':False,'regs':{},'err':0}
+      b=self.batch
+      b['reqs'].append((start,num))
+    if leader:
+      if self.clients>1: sleep(self.window)
+      with self.cond: self.batch=None # later requests start a new batch
+      err=0
+      for lo,n in self.mergereads(b['reqs']):
+        try:
+          with self.buslock:
+            vals=self.rdpsu.readregs(lo,n)
+            self.upreads+=1
+          for t in range(0,n): b['regs'][lo+t]=vals[t]
+        except KeyboardInterrupt: raise
+        except Exception as e: err=self.upstreamerr(e)
+      with self.cond:
+        b['err']=err
+        b['done']=True
+        self.cond.notify_all()
+    else:
+      with self.cond:
+        while not b['done']: self.cond.wait()
+    if any(x not in b['regs'] for x in range(start,start+num)): return b['err'] or 0x0B
+    return [b['regs'][x] for x in range(start,start+num)]
+
+  # join overlapping requested ranges, and ones with gaps cheaper to read through than another transaction
+  def mergereads(self,reqs):
+    addrs=set()
+    for s,n in reqs: addrs.update(range(s,s+n))
+    return self.rdpsu.mergeranges(sorted(addrs))
+
+  # write registers directly; returns None or exception code
+  def write(self,start,vals):
+    try:
+      with self.buslock:
+        if len(vals)==1: self.rdpsu.writereg(start,vals[0],cache=False)
+        else: self.rdpsu.writeregs(start,vals)
+      return None
+    except KeyboardInterrupt: raise
+    except Exception as e: return self.upstreamerr(e)
+
+  # map failure to exception code: the device's own, or gateway target failed to respond
+  def upstreamerr(self,e):
+    print('MBTCP:ERR:',e,file=stdlog)
+    if isinstance(e,RDModbusError): return e.code
+    try: self.rdpsu.close() # reconnect on next transaction
+    except Exception: pass
+    return 0x0B
+
+  # process one request PDU, return response PDU
+  def handlepdu(self,pdu):
+    func=0
+    try:
+      func=pdu[0]
+      if func==RDModbus.MODBUS_FUNC_READMULTI16:
+        start,num=unpack('>HH',pdu[1:5])
+        if num<1 or num>self.MAXREGS: return pack('>BB',func|0x80,3)
+        res=self.read(start,num)
+        if isinstance(res,int): return pack('>BB',func|0x80,res)
+        return pack('>BB'+'H'*num,func,2*num,*res)
+      if func==RDModbus.MODBUS_FUNC_WRITESINGLE16:
+        start,val=unpack('>HH',pdu[1:5])
+        err=self.write(start,[val])
+        return pdu[:5] if err==None else pack('>BB',func|0x80,err)
+      if func==RDModbus.MODBUS_FUNC_WRITEMULTI16:
+        start,num,nb=unpack('>HHB',pdu[1:6])
+        if num<1 or num>123 or nb!=2*num: return pack('>BB',func|0x80,3)
+        err=self.write(start,list(unpack('>'+'H'*num,pdu[6:6+nb])))
+        return pdu[:5] if err==None else pack('>BB',func|0x80,err)
+    except Exception: return pack('>BB',func|0x80,3) # malformed request
+    return pack('>BB',func|0x80,1) # illegal function
+
+  # serve MODBUS/TCP clients, thread per client
+  def serve(self,port):
+    import socketserver
+    gw=self
+    class MBAPHandler(socketserver.BaseRequestHandler):
+      def recvall(self,n):
+        b=b''
+        while len(b)<n:
+          r=self.request.recv(n-len(b))
+          if r==b'': raise EOFError
+          b+=r
+        return b
+      def handle(self):
+        with gw.cond: gw.clients+=1
+        try:
+          while True:
+            tid,pid,l,unit=unpack('>HHHB',self.recvall(7))
+            if l<2: break # no function code, framing lost
+            pdu=self.recvall(l-1)
+            if pid!=0: continue
+            resp=gw.handlepdu(pdu)
+            if gw.verb: print('MBTCP:',self.client_address[0],pdu.hex(),'->',resp.hex(),file=stdlog)
+            self.request.sendall(pack('>HHHB',tid,0,len(resp)+1,unit)+resp)
+        except (EOFError,OSError): pass
+        finally:
+          with gw.cond: gw.clients-=1
+    self.rdpsu.initregs()
+    socketserver.ThreadingTCPServer.allow_reuse_address=True
+    srv=socketserver.ThreadingTCPServer(('',port),MBAPHandler)
+    srv.daemon_threads=True
+    print('MBTCP: listening on port',port,file=stdlog)
+    try: srv.serve_forever()
+    finally:
+      srv.server_close()
+      print(f'MBTCP: {self.clreads} client reads served by {self.upreads} upstream reads',file=stdlog)
+
+
+
+##########################
+##
+##  DEVICE SIMULATOR
+##
+##########################
+
+
+# RD60xx device model answering MODBUS RTU functions 3, 6, 16 over the whole register map,
+# with resistive load, and configurable link faults for testing and benchmarking
+class RD60Simulator:
+  NREGS=512
+  verb=False
+
+  # link behaviour: delay before answer, its random +-spread, max bytes per send (0=whole frame),
+  # probabilities of dropped answer, corrupted CRC, exception answer
+  latency=0.0
+  jitter=0.0
+  split=0
+  drop=0.0
+  crcerr=0.0
+  excprob=0.0
+  load=10.0  # ohms, output load
+  OPTNAMES={'lat':'latency','jit':'jitter','split':'split','drop':'drop','crc':'crcerr','exc':'excprob','load':'load'}
+
+  def __init__(self,typename='RD6024',addr=DEFAULT_MODBUS_ADDR):
+    import random,threading
+    if typename not in PSU_RD60XX.RD_TYPES: raise ValueError('unknown type '+typename)
+    self.rnd=random.Random()
+    self.lock=threading.Lock()
+    self.modbus=RDModbus(addr) # for CRC
+    self.addr=addr
+    self.typename=typename
+    self.typ=PSU_RD60XX.RD_TYPES[typename]
+    self.vmult=self.typ['Vmult']
+    self.imult=self.typ['Imult']
+    self.regs=[0]*self.NREGS
+    self.regs[0]=[x for x in PSU_RD60XX.RD_IDNUMS if PSU_RD60XX.RD_IDNUMS[x]==typename][0]
+    self.regs[2]=12345  # serial number
+    self.regs[3]=138    # firmware 1.38
+    self.regs[5]=25;self.regs[7]=77
+    self.regs[8]=5*self.vmult;self.regs[9]=1*self.imult
+    self.regs[14]=int((self.typ['Vmax']+5)*self.vmult)
+    self.regs[34]=1;self.regs[36]=1 # external sensor disconnected
+    for m in range(0,10):
+      self.regs[80+4*m:84+4*m]=[5*self.vmult,1*self.imult,int(self.typ['Vmax']*1.03*self.vmult),int(self.typ['Imax']*1.03*self.imult)]
+    self.frames=0
+    self.update()
+
+  # options from "lat=0.01,jit=0.005,split=3,drop=0.01,crc=0.01,exc=0.01,load=4.7"
+  def setopts(self,opts):
+    for x in opts.split(','):
+      if x.strip()=='': continue
+      k,v=x.split('=')
+      k=self.OPTNAMES[k.strip().lower()]
+      setattr(self,k,type(getattr(self,k))(v))
+
+  # recompute measured values: constant voltage until current limit, then constant current
+  def update(self):
+    r=self.regs
+    v=r[8]/self.vmult
+    i=r[9]/self.imult
+    if r[80]!=r[8] or r[81]!=r[9]: r[80]=r[8];r[81]=r[9] # M0 mirrors setpoints
+    if r[8]>r[82] or r[9]>r[83]: r[16]=1;r[18]=0 # OVP/OCP trip
+    if r[18]==0: v=0;i=0;r[17]=0
+    elif v/self.load>i: v=i*self.load;r[17]=1
+    else: i=v/self.load;r[17]=0
+    r[10]=int(round(v*self.vmult))
+    r[11]=int(round(i*self.imult))
+    r[13]=int(round(v*i*100))
+    if self.typename=='RD6012P': r[20]=1 if r[9]>6*self.imult else 0
+
+  def exception(self,func,code):
+    return pack('>BBB',self.addr,func|0x80,code)
+
+  # process one request frame, return answer frame (None = no answer)
+  def process(self,frame):
+    if not self.modbus.modbus_check_crc(frame) or frame[0]!=self.addr: return None
+    func=frame[1]
+    with self.lock:
+      self.frames+=1
+      if self.excprob>0 and self.rnd.random()<self.excprob: res=self.exception(func,6) # slave busy
+      elif func==RDModbus.MODBUS_FUNC_READMULTI16:
+        start,num=unpack('>HH',frame[2:6])
+        if num<1 or num>125: res=self.exception(func,3)
+        elif start+num>self.NREGS: res=self.exception(func,2)
+        else: res=pack('>BBB'+'H'*num,self.addr,func,2*num,*self.regs[start:start+num])
+      elif func==RDModbus.MODBUS_FUNC_WRITESINGLE16:
+        start,val=unpack('>HH',frame[2:6])
+        if start>=self.NREGS: res=self.exception(func,2)
+        else: self.regs[start]=val;self.update();res=frame[:6]
+      elif func==RDModbus.MODBUS_FUNC_WRITEMULTI16:
+        start,num=unpack('>HH',frame[2:6])
+        if num<1 or num>123 or frame[6]!=2*num: res=self.exception(func,3)
+        elif start+num>self.NREGS: res=self.exception(func,2)
+        else: self.regs[start:start+num]=unpack('>'+'H'*num,frame[7:7+2*num]);self.update();res=frame[:6]
+      else: res=self.exception(func,1)
+    res=self.modbus.modbus_add_crc(res)
+    if self.drop>0 and self.rnd.random()<self.drop: return None
+    if self.crcerr>0 and self.rnd.random()<self.crcerr: res=res[:-1]+bytes([res[-1]^0x55])
+    if self.verb: print('SIM:',frame.hex(),'->',res.hex(),file=stdlog)
+    return res
+
+  # take complete request frames from start of buffer; returns frames, rest of buffer
+  def splitframes(self,buf):
+    frames=[]
+    while len(buf)>=8:
+      l=9+buf[6] if buf[1]==RDModbus.MODBUS_FUNC_WRITEMULTI16 else 8
+      if len(buf)<l: break
+      frames.append(bytes(buf[:l]))
+      buf=buf[l:]
+    return frames,buf
+
+  # answer delay and fragmentation as configured; write(bytes) sends to the link
+  def answer(self,res,write):
+    d=self.latency+(self.rnd.uniform(-self.jitter,self.jitter) if self.jitter>0 else 0)
+    if d>0: sleep(d)
+    step=self.split if self.split>0 else len(res)
+    for t in range(0,len(res),step):
+      if t>0: sleep(0.0005)
+      write(res[t:t+step])
+
+  # serve byte stream; read(n) returns bytes (b'' = closed)
+  def servestream(self,read,write):
+    buf=b''
+    while True:
+      r=read(1024)
+      if r==b'': return
+      buf+=r
+      frames,buf=self.splitframes(buf)
+      if frames==[] and len(buf)>=8 and not self.modbus.modbus_check_crc(buf[:8]) and buf[1] not in [3,6,16]: buf=b'' # garbage
+      for f in frames:
+        res=self.process(f)
+        if res!=None: self.answer(res,write)
+
+  # raw TCP bridge, like TasmoCOM; thread per client
+  def servetcp(self,port):
+    self.acceptloop(self.listentcp(port))
+
+  # open listening socket; port 0 picks a free one, see getsockname()
+  def listentcp(self,port,host=''):
+    import socket
+    srv=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    srv.bind((host,port))
+    srv.listen(5)
+    print('SIM:',self.typename,'on TCP port',srv.getsockname()[1],file=stdlog)
+    return srv
+
+  def acceptloop(self,srv):
+    import threading
+    def client(c):
+      try: self.servestream(c.recv,c.sendall)
+      except OSError: pass
+      finally: c.close()
+    try:
+      while True:
+        c,_=srv.accept()
+        threading.Thread(target=client,args=(c,),daemon=True).start()
+    finally:
+      srv.close()
+      print('SIM: frames processed:',self.frames,file=stdlog)
+
+  # pseudo-terminal, for serial port access
+  def servepty(self):
+    import os,tty
+    master,slave=os.openpty()
+    tty.setraw(slave)
+    print('SIM:',self.typename,'on serial port',os.ttyname(slave),file=stdlog)
+    try: self.servestream(lambda n: os.read(master,n),lambda b: os.write(master,b))
+    finally:
+      os.close(master);os.close(slave)
+      print('SIM: frames processed:',self.frames,file=stdlog)
+
+
+# in-process port to a simulator, same interface as the low level ports
+class SimPort:
+  verbconn=False
+  verbport=False
+  lowlatency=False
+  flushedbytes=0
+  connected=False
+  timeout=3
+
+  def __init__(self,sim):
+    self.sim=sim
+    self.rx=bytearray()
+    self.tx=b''
+
+  def connect(self): self.connected=True
+  def close(self): self.connected=False
+
+  def send(self,raw,showpacket=None):
+    frames,self.tx=self.sim.splitframes(self.tx+raw)
+    for f in frames:
+      res=self.sim.process(f)
+      if res!=None: self.sim.answer(res,self.rx.extend)
+
+  def recv(self,l,showpacket=None):
+    res=bytes(self.rx[:l])
+    del self.rx[:l]
+    return res
+
+  def recvinto(self,view,showpacket=None):
+    n=min(len(view),len(self.rx))
+    view[:n]=self.rx[:n]
+    del self.rx[:n]
+    return n
+
+  def recvflush(self):
+    n=len(self.rx)
+    self.rx.clear()
+    self.flushedbytes+=n
+    return n
+
+  def settimeout(self,timeout): self.timeout=timeout
 
 
 
@@ -1484,11 +3917,25 @@ class PowerSupply:
 #######################################
 
 
+# print times of startup phases, from timing marks
+def printtiming():
+  a=[('interpreter start (cpu)',loadcpu)]
+  t=loadstart
+  for x,y in timing.items(): a.append((x,y-t));t=y
+  print('TIMING:',', '.join(f'{x} {1000*y:.2f} ms' for x,y in a)+f', total {1000*(t-loadstart+loadcpu):.2f} ms',file=stdlog)
+
+
 if __name__=="__main__":
   cmds=argv[1:]
+  if any(x.upper() in ['TIMING','--TIMING'] for x in cmds): timing={}
+  timemark('module load')
 
   psu=PowerSupply()
   psu.readconf() # set config file
+  timemark('config')
+
+  # thin client, no port opened here; the daemon owns the connection
+  if len(cmds)>0 and cmds[0][:6].upper()=='CLIENT': psu.runclient(cmds[0][7:],cmds[1:])
 
   if len(cmds)==1 and (cmds[0][:4].upper()=='TCP=' or cmds[0][:5].upper()=='PORT='): cmds.append('STATE')
   elif cmds==[]: cmds=['STATE']
@@ -1496,6 +3943,7 @@ if __name__=="__main__":
   if not psu.verifycommands(cmds):
     print('Command error.',file=stderr)
     exit(1)
+  timemark('verify')
 
   # now we read the config, processed parameters by a dry run, and know the port to use
   psu.initport()
@@ -1504,11 +3952,19 @@ if __name__=="__main__":
   if False:
     psu.handlecommands(cmds); psu.close() # no exception catching, for debug
   else:
+    rc=0
     try:
       psu.handlecommands(cmds)
+      timemark('commands and output')
     except KeyboardInterrupt: pass # clean break
+    except RDError as e: print(e,file=stdlog);rc=e.exitcode # device layer failures as exit codes
     finally:
-      psu.close()
+      try: psu.close()
+      except RDError as e:
+        if rc==0: print(e,file=stdlog);rc=e.exitcode
       if psu.lastcmd[:5]=='SLEEP' and psu.qend==' ': print()
+      timemark('close')
+      if timing!=None: printtiming()
+    if rc!=0: exit(rc)
 
 
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+# rd60.py benchmark: command latency and MODBUS throughput against the simulator,
+# in the same process (no socket) and over loopback TCP
+# results as table, optionally saved as JSON for comparison between versions
+# -check runs the regression checks of behaviour the numbers depend on
+
+import rd60
+from time import monotonic,process_time
+from sys import argv,exit
+
+
+# scenarios: name, commands run per measured iteration
+SCENARIOS=[
+  ['QV',         ['QV']],
+  ['STATE',      ['STATE']],
+  ['JSTATE',     ['JSTATE']],
+  ['REGSALL',    ['REGSALL']],
+  ['LOOPSET',    ['5V','LOOP:10','+0.01V']],
+  ['WRITECACHE', ['5V','1A','5.5VO','1.1AO','ON']],
+]
+
+# function name fragments for the time breakdown with profiling
+PROFILE_GROUPS={
+  'crc':    ['modbus_crc16','crc16','modbus_check_crc','modbus_add_crc','mframe'],
+  'struct': ['pack','unpack','get16bitarr'],
+  'print':  ['print','dumps','write'],
+  'wait':   ['recv_into','recv','sendall','select','sleep'],
+}
+
+
+# port wrapper counting frames and bytes; flushwait makes the flush block like the TCP one without FAST
+class CountingPort:
+  def __init__(self,port):
+    self.__dict__.update(port=port,frames=0,sent=0,recvd=0,flushwait=0)
+
+  # port settings go through to the port
+  def __getattr__(self,name): return getattr(self.port,name)
+  def __setattr__(self,name,val):
+    if name in self.__dict__: self.__dict__[name]=val
+    else: setattr(self.port,name,val)
+
+  def connect(self): return self.port.connect()
+  def close(self): return self.port.close()
+  def recvflush(self):
+    if self.flushwait>0: rd60.sleep(self.flushwait)
+    return self.port.recvflush()
+
+  def send(self,raw,showpacket=None):
+    self.frames+=1
+    self.sent+=len(raw)
+    return self.port.send(raw,showpacket)
+
+  def recvinto(self,view,showpacket=None):
+    n=self.port.recvinto(view,showpacket)
+    self.recvd+=n
+    return n
+
+
+def percentile(a,p):
+  a=sorted(a)
+  return a[int(round(p*(len(a)-1)))]
+
+
+# make command interpreter on given port; every sync reads the device, like a fresh process would
+def makepsu(port,fast=False):
+  ps=rd60.PowerSupply()
+  ps.conf={}
+  ps.rdpsu=rd60.PSU_RD60XX(port)
+  ps.rdpsu.readcachetimeout=0
+  ps.rdpsu.lowlatency=fast
+  ps.rdpsu.initregs()
+  return ps
+
+
+# run commands n times, return stats dict
+def runscenario(ps,port,cmds,n):
+  from contextlib import redirect_stdout
+  import os
+  lat=[]
+  f0,s0,r0=port.frames,port.sent,port.recvd
+  with open(os.devnull,'w') as null, redirect_stdout(null):
+    c0=process_time()
+    t0=monotonic()
+    for t in range(0,n):
+      t1=monotonic()
+      ps.handlecommands(cmds)
+      lat.append(monotonic()-t1)
+    wall=monotonic()-t0
+    cpu=process_time()-c0
+  frames=port.frames-f0
+  nbytes=port.sent-s0+port.recvd-r0
+  return {
+    'n':n,
+    'p50_ms':round(1000*percentile(lat,0.50),3),
+    'p95_ms':round(1000*percentile(lat,0.95),3),
+    'p99_ms':round(1000*percentile(lat,0.99),3),
+    'tps':round(frames/wall,1),
+    'frames_per_cmd':round(frames/n,2),
+    'bytes_per_cmd':round(nbytes/n,1),
+    'cpu_us_per_tx':round(1e6*cpu/max(1,frames),1),
+  }
+
+
+# time spent in function groups, from profile of one scenario run
+def profilescenario(ps,port,cmds,n):
+  import cProfile,pstats,os
+  from contextlib import redirect_stdout
+  prof=cProfile.Profile()
+  with open(os.devnull,'w') as null, redirect_stdout(null):
+    prof.enable()
+    for t in range(0,n): ps.handlecommands(cmds)
+    prof.disable()
+  st=pstats.Stats(prof).stats
+  total=sum(v[2] for v in st.values())
+  res={}
+  for g in PROFILE_GROUPS:
+    tt=sum(v[2] for k,v in st.items() if any(k[2]==x or '.'+x+'>' in k[2] or "'"+x+"'" in k[2] for x in PROFILE_GROUPS[g]))
+    res[g+'_pct']=round(100*tt/total,1) if total>0 else 0
+  return res
+
+
+# in-process simulator, or simulator in separate process on loopback TCP (its CPU time is not counted then)
+# returns port, simulator process or None
+def maketransport(kind,latency):
+  if kind=='inproc':
+    sim=rd60.RD60Simulator('RD6024')
+    sim.latency=latency
+    return CountingPort(rd60.SimPort(sim)),None
+  import socket,subprocess
+  from sys import executable
+  s=socket.socket()
+  s.bind(('127.0.0.1',0))
+  port=s.getsockname()[1]
+  s.close()
+  proc=subprocess.Popen([executable,rd60.__file__,f'sim:{port}:RD6024:lat={latency}'],stderr=subprocess.DEVNULL)
+  for t in range(0,50):
+    try: socket.create_connection(('127.0.0.1',port),timeout=1).close();break
+    except OSError: rd60.sleep(0.1)
+  return CountingPort(rd60.LowLevelTcpPort('127.0.0.1',port)),proc
+
+
+# CRC and request framing, per call: reference byte-table CRC of the included modbus_crc module against
+# the word-table one, request frame packed each time against the memo
+def codecbench(n):
+  import os
+  from timeit import timeit
+  m=rd60.RDModbus()
+  m.crctable16() # built outside of timing
+  req=rd60.pack('>BBHH',1,3,4,16)
+  resp=os.urandom(87)
+  def oldframe(): p=rd60.pack('>BB',m.addr,3)+rd60.pack('>HH',4,16);return p+m.modbus_crc16(p)
+  cases=[
+    ['crc req 6B',  lambda: m.modbus_crc16(req),              lambda: m.crc16(req)],
+    ['crc resp 87B',lambda: m.modbus_crc16(resp),             lambda: m.crc16(resp)],
+    ['frame read',  oldframe,                                 lambda: m.mframe(3,rd60.pack('>HH',4,16))],
+  ]
+  print(f'{"codec":<14} {"ref us":>8} {"new us":>8} {"speedup":>8}')
+  for name,ref,new in cases:
+    a=timeit(ref,number=n)/n*1e6
+    b=timeit(new,number=n)/n*1e6
+    print(f'{name:<14} {a:>8.2f} {b:>8.2f} {a/b:>7.1f}x')
+
+
+##### regression checks: each returns None when passed, or what went wrong
+
+# daemon request on a socket pair, returns the output text and return code
+def daemonrequest(ps,line):
+  import socket
+  a,b=socket.socketpair()
+  a.sendall(line.encode()+b'\n')
+  try: ps.daemonrequest(b)
+  finally: b.close()
+  res=b''
+  while True:
+    x=a.recv(4096)
+    if x==b'': break
+    res+=x
+  a.close()
+  out,_,rc=res.decode().partition('\0')
+  return out,int(rc)
+
+# modes set by one daemon client do not stay for the next one
+def checkdaemonmodes():
+  port,_=maketransport('inproc',0)
+  ps=makepsu(port)
+  daemonrequest(ps,'VERB LINE BAT STATS::5 QV QA')
+  changed=[x for x,y in [('VERB',ps.rdpsu.modbus.verbm),('BAT',ps.rdpsu.bat or ps.rdpsu.bat_forcemode),('STATS',ps.statsperiod!=0)] if y]
+  out,rc=daemonrequest(ps,'QV QA')
+  if out.count('\n')!=2: changed.append('LINE')
+  if changed!=[]: return 'kept after request: '+' '.join(changed)
+
+# SCPI long forms with all the default nodes, as instrument drivers send them
+def checkscpinodes():
+  import threading
+  port,_=maketransport('inproc',0)
+  ps=makepsu(port)
+  lock=threading.Lock()
+  errs=[]
+  cmd=lambda c: ps.scpicommand(c,lock,errs)
+  cmd('SOURCE:VOLTAGE:LEVEL:IMMEDIATE:AMPLITUDE 5')
+  cmd('CURR:LEV:IMM 1.0')
+  res=[cmd('SOUR:VOLT:LEV:IMM:AMPL?'),cmd('CURR:LEV:IMM?'),cmd('SOUR:VOLT:LEV:IMM?')]
+  if errs!=[] or res!=['5.0','1.0','5.0']: return f'answers {res}, errors {errs}'
+
+# round trips start when the request goes out, the wait for stale data before is not link time
+def checkrttflush():
+  port,_=maketransport('inproc',0)
+  port.flushwait=0.02
+  ps=makepsu(port)
+  for t in range(0,5): ps.handlecommands(['QV'])
+  m=ps.rdpsu.modbus
+  worst=max(x['rttmax'] for x in m.stats.getstats()['ranges'] if 'rttmax' in x)
+  if worst>=10 or m.turnaround>=0.01: return f'round trip up to {worst} ms, turnaround {1000*m.turnaround:.1f} ms with 20 ms flush'
+
+# run commands like a fresh process with cached profile, on a fresh connection; returns (start,num) of the reads
+def oneshot(port,cmds,profile):
+  ps=rd60.PowerSupply()
+  ps.conf={}
+  ps.rdpsu=rd60.PSU_RD60XX(port)
+  ps.rdpsu.profile=profile
+  ps.handlecommands(cmds)
+  return [(x['start'],x['num']) for x in ps.rdpsu.modbus.stats.getstats()['ranges'] if x['func']==3 for t in range(0,x['req'])]
+
+# the read planner gets the link cost from wire time, the same with and without the blocking flush
+def checkplanflush():
+  port,_=maketransport('inproc',0)
+  profile=makepsu(port).rdpsu.getprofile()
+  fast=oneshot(port,['STATE'],profile)
+  port.flushwait=0.02
+  slow=oneshot(port,['STATE'],profile)
+  if slow!=fast: return f'STATE reads {slow} with 20 ms flush, {fast} without'
+
+# with cached profile, one-shot STATE is the identification read and OVP/OCP; a damaged profile is not used
+def checkprofile():
+  port,_=maketransport('inproc',0)
+  profile=makepsu(port).rdpsu.getprofile()
+  reads=oneshot(port,['STATE'],profile)
+  if reads!=[(0,33),(82,2)]: return f'STATE reads {reads}'
+  reads=oneshot(port,['QV'],dict(profile,vmult='10'))
+  if reads[0]!=(0,42): return f'damaged profile used, reads {reads}'
+
+# short state reads the output values only: one transaction, and one more for the battery voltage when forced
+def checkshortstate():
+  port,_=maketransport('inproc',0)
+  profile=makepsu(port).rdpsu.getprofile()
+  res={x:len(oneshot(port,[x],profile)) for x in ['STATE:S','JSTATE:S','STATE:SB']}
+  if res!={'STATE:S':1,'JSTATE:S':1,'STATE:SB':2}: return f'transactions {res}'
+
+CHECKS=[
+  ['daemonmodes', checkdaemonmodes],
+  ['scpinodes',   checkscpinodes],
+  ['rttflush',    checkrttflush],
+  ['planflush',   checkplanflush],
+  ['profile',     checkprofile],
+  ['shortstate',  checkshortstate],
+]
+
+def runchecks():
+  from contextlib import redirect_stdout
+  import os
+  failed=0
+  with open(os.devnull,'w') as null:
+    rd60.stdlog=null
+    for name,fn in CHECKS:
+      with redirect_stdout(null): err=fn()
+      print(f'{name:<14} {"ok" if err==None else "FAILED: "+err}')
+      if err!=None: failed+=1
+  exit(1 if failed>0 else 0)
+
+
+def usage():
+  print('rd60.py benchmark')
+  print('Usage:',argv[0],'[-n iterations] [-t inproc|tcp] [-s scenario[,scenario]] [-lat seconds] [-fast] [-p] [-o result.json] [-label text]')
+  print('      ',argv[0],'-codec [-n iterations]')
+  print('      ',argv[0],'-check')
+  print('  -lat    simulator answer delay')
+  print('  -fast   FAST mode of the port')
+  print('  -p      add time breakdown (crc, struct, print, wait for socket or sleep) from profiling')
+  print('  -codec  microbenchmark of CRC and request frame building only')
+  print('  -check  regression checks against the in-process simulator, exit code 1 if any fails')
+  print('Scenarios:',' '.join(x[0] for x in SCENARIOS))
+  exit(0)
+
+
+if __name__=="__main__":
+  n=50
+  kinds=['inproc','tcp']
+  fast=False
+  only=None
+  latency=0.0
+  prof=False
+  outfile=None
+  label=''
+  codec=False
+  a=argv[1:]
+  try:
+    while a!=[]:
+      x=a.pop(0)
+      if x=='-n': n=int(a.pop(0))
+      elif x=='-t': kinds=[a.pop(0)]
+      elif x=='-fast': fast=True
+      elif x=='-s': only=a.pop(0).upper().split(',')
+      elif x=='-lat': latency=float(a.pop(0))
+      elif x=='-p': prof=True
+      elif x=='-o': outfile=a.pop(0)
+      elif x=='-label': label=a.pop(0)
+      elif x=='-codec': codec=True
+      elif x=='-check': runchecks()
+      else: usage()
+  except (IndexError,ValueError): usage()
+  if codec: codecbench(1000*n);exit(0)
+
+  results={'label':label,'iterations':n,'latency':latency,'fast':fast,'results':{}}
+  print(f'{"transport":<8} {"scenario":<11} {"p50ms":>8} {"p95ms":>8} {"p99ms":>8} {"tx/s":>8} {"tx/cmd":>7} {"B/cmd":>7} {"cpuus/tx":>9}')
+  for kind in kinds:
+    port,proc=maketransport(kind,latency)
+    ps=makepsu(port,fast)
+    for name,cmds in SCENARIOS:
+      if only!=None and name not in only: continue
+      r=runscenario(ps,port,cmds,n)
+      if prof: r.update(profilescenario(ps,port,cmds,n))
+      results['results'][kind+':'+name]=r
+      print(f'{kind:<8} {name:<11} {r["p50_ms"]:>8} {r["p95_ms"]:>8} {r["p99_ms"]:>8} {r["tps"]:>8} {r["frames_per_cmd"]:>7} {r["bytes_per_cmd"]:>7} {r["cpu_us_per_tx"]:>9}',end='')
+      if prof: print('  '+' '.join(f'{g}={r[g+"_pct"]}%' for g in PROFILE_GROUPS),end='')
+      print()
+    ps.close()
+    if proc!=None: proc.terminate()
+
+  if outfile!=None:
+    import json,platform
+    from datetime import datetime
+    results['time']=datetime.now().isoformat()[:19]
+    results['python']=platform.python_version()
+    with open(outfile,'w') as f: json.dump(results,f,indent=1)
+    print('saved to',outfile)